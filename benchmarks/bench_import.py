@@ -0,0 +1,49 @@
+"""Benchmark the import time of the seemore package.
+
+`import seemore` only loads the model registry. torch and cv2 are imported on
+first use of SeemoReUpscaler, which is measured separately.
+
+    python benchmarks/bench_import.py
+"""
+
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..", "src")
+
+STATEMENTS = {
+    "import seemore": "import seemore; seemore.seemore_model_cfgs",
+    "from seemore import SeemoReUpscaler": "from seemore import SeemoReUpscaler",
+}
+
+
+def import_time(statement: str, repeat: int = 5) -> float:
+    """Best wall time in seconds of running statement in a fresh interpreter"""
+    code = (
+        "import time; start = time.perf_counter(); "
+        f"{statement}; print(time.perf_counter() - start)"
+    )
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    times = [
+        float(
+            subprocess.run(
+                [sys.executable, "-c", code],
+                env=env,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        )
+        for _ in range(repeat)
+    ]
+    return min(times)
+
+
+def main():
+    for name, statement in STATEMENTS.items():
+        print(f"{name:<40} {import_time(statement) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
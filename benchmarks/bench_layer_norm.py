@@ -0,0 +1,92 @@
+"""Benchmark the channels_first LayerNorm of SeemoRe.
+
+Compares the fused LayerNorm with the former mean, variance and affine
+passes, on contiguous and channels_last inputs of the embedding width of the
+models.
+
+    python benchmarks/bench_layer_norm.py --size 512 --channels 48
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from seemore.module import LayerNorm  # noqa: E402
+
+
+def baseline(norm: LayerNorm, x: torch.Tensor) -> torch.Tensor:
+    # LayerNorm.forward before it was fused
+    u = x.mean(1, keepdim=True)
+    s = (x - u).pow(2).mean(1, keepdim=True)
+    x = (x - u) / torch.sqrt(s + norm.eps)
+    x = norm.weight[:, None, None] * x + norm.bias[:, None, None]
+    return x
+
+
+def fused(norm: LayerNorm, x: torch.Tensor) -> torch.Tensor:
+    return norm(x)
+
+
+VARIANTS = {"baseline": baseline, "fused": fused}
+MEMORY_FORMATS = {
+    "contiguous": torch.contiguous_format,
+    "channels_last": torch.channels_last,
+}
+
+
+@torch.inference_mode()
+def run(norm: LayerNorm, x: torch.Tensor, name: str, repeat: int) -> float:
+    VARIANTS[name](norm, x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        VARIANTS[name](norm, x)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--channels", type=int, default=48)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32")
+    args = parser.parse_args()
+
+    dtype = getattr(torch, args.dtype)
+    torch.manual_seed(0)
+    norm = LayerNorm(args.channels, data_format="channels_first")
+    with torch.no_grad():
+        norm.weight.normal_()
+        norm.bias.normal_()
+    norm = norm.to(device=args.device, dtype=dtype)
+    x = torch.randn(
+        args.batch, args.channels, args.size, args.size, device=args.device, dtype=dtype
+    )
+
+    print(f"{args.batch}x{args.channels}x{args.size}x{args.size} {args.dtype}")
+    print(f"{'memory format':<15} {'variant':<10} {'time':>13} {'max error':>12}")
+    for format_name, memory_format in MEMORY_FORMATS.items():
+        inputs = x.contiguous(memory_format=memory_format)
+        with torch.inference_mode():
+            expected = baseline(norm, inputs.float())
+        for name in VARIANTS:
+            elapsed = run(norm, inputs, name, args.repeat)
+            with torch.inference_mode():
+                error = (VARIANTS[name](norm, inputs).float() - expected).abs().max()
+            print(
+                f"{format_name:<15} {name:<10} {elapsed * 1000:10.2f} ms {error.item():12.2e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Benchmark the pre/post-processing of SeemoReUpscaler.__call__.
+
+The network is replaced by a nearest neighbour upsampling, so only the
+conversions between the uint8 image and the float tensors are measured. Every
+variant runs in a fresh process to get its own peak RSS.
+
+    python benchmarks/bench_pipeline.py --size 2048 --scale 4
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from seemore.core import image_to_tensor, quantize_to_uint8  # noqa: E402
+
+
+def fake_model(y: torch.Tensor, scale: int) -> torch.Tensor:
+    return F.interpolate(y, scale_factor=scale, mode="nearest")
+
+
+def baseline(np_img: np.ndarray, scale: int) -> np.ndarray:
+    # SeemoReUpscaler.__call__ before the pipeline was reworked
+    rgb_np_img = cv2.cvtColor(np_img, cv2.COLOR_BGR2RGB)
+    y = torch.tensor(rgb_np_img).permute(2, 0, 1).unsqueeze(0)
+    y = y / 255.0
+    x_hat = fake_model(y, scale)
+    restored_img = x_hat.squeeze().permute(1, 2, 0).clamp_(0, 1).cpu().numpy()
+    restored_img = np.clip(restored_img, 0.0, 1.0)
+    restored_img = (restored_img * 255.0).round().astype(np.uint8)
+    return cv2.cvtColor(restored_img, cv2.COLOR_RGB2BGR)
+
+
+def current(np_img: np.ndarray, scale: int) -> np.ndarray:
+    h, w = np_img.shape[:2]
+    restored_img = np.empty((h * scale, w * scale, 3), dtype=np.uint8)
+    # The channel order and the [0, 255] range are folded into the model
+    y = image_to_tensor(np_img)
+    quantize_to_uint8(fake_model(y, scale), restored_img)
+    return restored_img
+
+
+PIPELINES = {"baseline": baseline, "current": current}
+
+
+def run(name: str, size: int, scale: int, repeat: int):
+    np_img = np.random.default_rng(0).integers(0, 256, (size, size, 3), np.uint8)
+    PIPELINES[name](np_img, scale)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        PIPELINES[name](np_img, scale)
+    elapsed = (time.perf_counter() - start) / repeat
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{name:<10} {elapsed * 1000:10.1f} ms {peak_rss:10.0f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--scale", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--pipeline", choices=PIPELINES)
+    args = parser.parse_args()
+
+    if args.pipeline:
+        run(args.pipeline, args.size, args.scale, args.repeat)
+        return
+
+    print(f"{args.size}x{args.size} input, x{args.scale}")
+    print(f"{'pipeline':<10} {'time':>13} {'peak RSS':>14}")
+    for name in PIPELINES:
+        subprocess.run(
+            [sys.executable, __file__, "--pipeline", name]
+            + ["--size", str(args.size), "--scale", str(args.scale)]
+            + ["--repeat", str(args.repeat)],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
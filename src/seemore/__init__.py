@@ -1,3 +1,27 @@
-from .core import SeemoReUpscaler
+import importlib
 
-__all__ = ["SeemoReUpscaler"]
+from .cfgs import seemore_model_cfgs
+
+__version__ = "0.1.0"
+
+__all__ = ["OrtUpscaler", "SeemoReUpscaler", "UpscalerManager", "seemore_model_cfgs"]
+
+# torch and cv2 are only imported once an upscaler is actually used
+_lazy_attributes = {
+    "OrtUpscaler": "ort",
+    "SeemoReUpscaler": "core",
+    "UpscalerManager": "manager",
+}
+
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        module = importlib.import_module(f".{_lazy_attributes[name]}", __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_lazy_attributes))
@@ -0,0 +1,166 @@
+"""Single-file bundle of the weights of several models.
+
+Layout: an 8 byte magic, the little-endian uint64 length of a JSON index,
+the index itself, then the raw tensor data. Every tensor starts at a multiple
+of ALIGNMENT from the start of the file, so it can be used straight from a
+memory map. Weights may be stored as float16 or bfloat16 to halve the file,
+they are upcast when a model is loaded.
+
+    python -m seemore.bundle seemore.bundle --storage-dtype float16
+"""
+
+import argparse
+import functools
+import json
+import mmap
+import os
+import struct
+from typing import Dict, List, Optional
+
+import torch
+
+from seemore.download import atomic_write
+
+MAGIC = b"SEEMORE\x00"
+ALIGNMENT = 64
+STORAGE_DTYPES = ("float32", "float16", "bfloat16")
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_bundle(
+    path: str,
+    state_dicts: Dict[str, Dict[str, torch.Tensor]],
+    storage_dtype: torch.dtype = torch.float32,
+):
+    """Write the state dicts of several models, keyed by model name, to path"""
+    tensors = []
+    models = {}
+    offset = 0
+    for model_name, state_dict in state_dicts.items():
+        entries = {}
+        for key, tensor in state_dict.items():
+            tensor = tensor.detach().cpu()
+            if tensor.is_floating_point():
+                tensor = tensor.to(storage_dtype)
+            tensor = tensor.contiguous()
+            entries[key] = {
+                "dtype": str(tensor.dtype).replace("torch.", ""),
+                "shape": list(tensor.shape),
+                "offset": offset,
+            }
+            tensors.append((offset, tensor))
+            offset = _align(offset + tensor.numel() * tensor.element_size())
+        models[model_name] = entries
+
+    index = json.dumps(
+        {"storage_dtype": str(storage_dtype).replace("torch.", ""), "models": models}
+    ).encode()
+    data_offset = _align(len(MAGIC) + 8 + len(index))
+
+    with atomic_write(path) as tmp_path, open(tmp_path, "wb") as f:
+        f.write(MAGIC + struct.pack("<Q", len(index)) + index)
+        for tensor_offset, tensor in tensors:
+            f.seek(data_offset + tensor_offset)
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+
+
+class WeightBundle:
+    """Read access to a bundle written by write_bundle()"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(len(MAGIC) + 8)
+            if len(header) != len(MAGIC) + 8 or header[: len(MAGIC)] != MAGIC:
+                raise ValueError(f"{path} is not a seemore weight bundle")
+            (index_length,) = struct.unpack("<Q", header[len(MAGIC) :])
+            index = json.loads(f.read(index_length))
+        self.storage_dtype = getattr(torch, index["storage_dtype"])
+        self._models = index["models"]
+        self._data_offset = _align(len(MAGIC) + 8 + index_length)
+
+    def model_names(self) -> List[str]:
+        return list(self._models)
+
+    def __contains__(self, model_name: str) -> bool:
+        return model_name in self._models
+
+    def state_dict(
+        self, model_name: str, dtype: torch.dtype = torch.float32
+    ) -> Dict[str, torch.Tensor]:
+        """Tensors of model_name, floating point ones as dtype.
+
+        Tensors stored as dtype are views of a private, copy-on-write memory
+        map of the bundle, so modifying them in place does not affect the file
+        or other models loaded from it.
+        """
+        if model_name not in self._models:
+            raise KeyError(
+                f"Model {model_name} not in {self.path}, available models: {self.model_names()}"
+            )
+        with open(self.path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        state_dict = {}
+        for key, entry in self._models[model_name].items():
+            tensor_dtype = getattr(torch, entry["dtype"])
+            shape = entry["shape"]
+            numel = 1
+            for size in shape:
+                numel *= size
+            if numel == 0:
+                tensor = torch.empty(shape, dtype=tensor_dtype)
+            else:
+                tensor = torch.frombuffer(
+                    buffer,
+                    dtype=tensor_dtype,
+                    count=numel,
+                    offset=self._data_offset + entry["offset"],
+                ).view(shape)
+            if tensor.is_floating_point():
+                tensor = tensor.to(dtype)
+            state_dict[key] = tensor
+        return state_dict
+
+
+@functools.lru_cache(maxsize=None)
+def _open_bundle(path: str, size: int, mtime_ns: int) -> WeightBundle:
+    return WeightBundle(path)
+
+
+def open_bundle(path: str) -> WeightBundle:
+    """WeightBundle of path, the index is only read once per version of the
+    file in the process. A rewritten bundle is told apart by its size and
+    mtime, like seemore.ort.bundle_suffix does.
+    """
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    return _open_bundle(path, st.st_size, st.st_mtime_ns)
+
+
+def main(args: Optional[List[str]] = None):
+    from seemore.cfgs import seemore_model_cfgs
+    from seemore.core import load_state_dict
+    from seemore.download import download_model
+
+    parser = argparse.ArgumentParser(description="Bundle pretrained SeemoRe weights")
+    parser.add_argument("path")
+    parser.add_argument("models", nargs="*", help="default: all models")
+    parser.add_argument("--storage-dtype", choices=STORAGE_DTYPES, default="float32")
+    args = parser.parse_args(args)
+
+    state_dicts = {}
+    for model_name in args.models or list(seemore_model_cfgs):
+        model_cfg = seemore_model_cfgs[model_name]
+        ckpt_path = download_model(
+            model_cfg["url"], sha256=model_cfg["sha256"], mirrors=model_cfg["mirrors"]
+        )
+        state_dicts[model_name] = load_state_dict(ckpt_path)
+    write_bundle(args.path, state_dicts, getattr(torch, args.storage_dtype))
+
+
+if __name__ == "__main__":
+    main()
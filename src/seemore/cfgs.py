@@ -0,0 +1,88 @@
+"""Model registry, kept free of heavy imports so it can be listed cheaply"""
+
+seemore_t_base_cfg = {
+    "in_chans": 3,
+    "num_experts": 3,
+    "img_range": 1.0,
+    "num_layers": 6,
+    "embedding_dim": 36,
+    "use_shuffle": True,
+    "lr_space": "exp",
+    "topk": 1,
+    "recursive": 2,
+    "global_kernel_size": 11,
+}
+
+seemore_b_base_cfg = {
+    "in_chans": 3,
+    "num_experts": 3,
+    "img_range": 1.0,
+    "num_layers": 8,
+    "embedding_dim": 48,
+    "use_shuffle": True,
+    "lr_space": "exp",
+    "topk": 1,
+    "recursive": 2,
+    "global_kernel_size": 11,
+}
+
+# Entries of seemore_model_cfgs that describe the checkpoint, not the network.
+# "sha256" is the digest of the release checkpoint, None trusts the first
+# download and checks the cached file against the digest recorded then.
+# "mirrors" lists alternative urls of the checkpoint, tried in order when "url"
+# cannot be downloaded.
+DOWNLOAD_KEYS = ("url", "sha256", "mirrors")
+
+seemore_model_cfgs = {
+    "seemore_b_x2": {
+        "scale": 2,
+        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_B_X2.pth",
+        "sha256": None,
+        "mirrors": [],
+        **seemore_b_base_cfg,
+    },
+    "seemore_b_x3": {
+        "scale": 3,
+        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_B_X3.pth",
+        "sha256": None,
+        "mirrors": [],
+        **seemore_b_base_cfg,
+    },
+    "seemore_b_x4": {
+        "scale": 4,
+        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_B_X4.pth",
+        "sha256": None,
+        "mirrors": [],
+        **seemore_b_base_cfg,
+    },
+    "seemore_t_x2": {
+        "scale": 2,
+        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_T_X2.pth",
+        "sha256": None,
+        "mirrors": [],
+        **seemore_t_base_cfg,
+    },
+    "seemore_t_x3": {
+        "scale": 3,
+        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_T_X3.pth",
+        "sha256": None,
+        "mirrors": [],
+        **seemore_t_base_cfg,
+    },
+    "seemore_t_x4": {
+        "scale": 4,
+        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_T_X4.pth",
+        "sha256": None,
+        "mirrors": [],
+        **seemore_t_base_cfg,
+    },
+}
+
+
+def network_cfg(model_name: str) -> dict:
+    """Keyword arguments of SeemoRe for model_name"""
+    return {
+        k: v
+        for k, v in seemore_model_cfgs[model_name].items()
+        if k not in DOWNLOAD_KEYS
+    }
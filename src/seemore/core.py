@@ -1,112 +1,409 @@
-from copy import deepcopy
-import hashlib
+from concurrent.futures import Future, ThreadPoolExecutor
+import glob
+import inspect
 import math
 
 import os
-from urllib.parse import urlparse
+import threading
+import warnings
+from typing import Dict, Iterator, NamedTuple, Optional, Sequence, Tuple, Union
 import cv2
 import torch
-from torch.hub import download_url_to_file, get_dir
+import torch.nn.functional as F
 import numpy as np
 
-from seemore.module import SeemoRe
+from seemore.bundle import open_bundle
+from seemore.cfgs import (
+    network_cfg,
+    seemore_b_base_cfg,
+    seemore_model_cfgs,
+    seemore_t_base_cfg,
+)
+from seemore.download import (
+    atomic_write,
+    download_model,
+    file_sha256,
+    get_cache_path_by_url,  # re-exported, it used to be defined here
+    get_hub_dir,
+    md5sum,  # re-exported, it used to be defined here
+)
+from seemore.model_cache import model_cache
+from seemore.ort import bundle_suffix, create_session, onnx_artifact_path
+from seemore.module import SeemoRe, tile_windows
+
+# Memory budget for the activations of one batch of tiles
+DEFAULT_TILE_MEMORY_BYTES = 1 << 30
+
+
+def estimate_memory_bytes(
+    model_cfg: dict,
+    height: int,
+    width: int,
+    batch_size: int = 1,
+    dtype: torch.dtype = torch.float32,
+) -> int:
+    """Rough upper bound of the peak memory of one forward pass.
+
+    Layers run one after another, so the peak does not depend on num_layers.
+    It is about ten embedding_dim sized feature maps at input resolution, plus
+    the upscaled output.
+    """
+    itemsize = torch.tensor([], dtype=dtype).element_size()
+    per_pixel = 12 * model_cfg["embedding_dim"] + 2 * 3 * model_cfg["scale"] ** 2
+    return batch_size * height * width * per_pixel * itemsize
+
+
+def receptive_field(model_cfg: dict, include_calibrate: bool = True) -> int:
+    """Radius in input pixels of the receptive field of a SeemoRe model.
+
+    The global average pooling of the MoE Router is left out, as it sees the
+    whole image. With include_calibrate=False the coarse calibration branch of
+    MoEBlock is left out too, which gives the purely local receptive field.
+    """
+    # conv_1 3x3, then conv_2 striped 3 taps
+    moe_block = 1 + 1
+    if include_calibrate:
+        # Each cell of the calibration map aggregates a stride x stride block.
+        # The bilinear upsampling reads the two cells around a pixel centre and
+        # the 3x3 conv one cell more, the farthest of them ends 2.5 cells away.
+        stride = 4 ** model_cfg["recursive"]
+        moe_block = 1 + max(1, 2 * stride + stride // 2 - 1)
+    gated_ffn = 1
+    striped_conv_former = model_cfg["global_kernel_size"] // 2
+    res_group = moe_block + gated_ffn + striped_conv_former + gated_ffn
+    # conv_1, body, conv_2 and the upsampler conv
+    return 1 + model_cfg["num_layers"] * res_group + 1 + 1
+
+
+def halo_overhead(tile_size: int, tile_pad: int) -> float:
+    """Fraction of redundant compute spent on the padding around a tile"""
+    return (tile_size + 2 * tile_pad) ** 2 / tile_size**2 - 1
+
+
+class TilePad(NamedTuple):
+    tile_pad: int
+    # First order estimate of the mean absolute error of the output next to a
+    # seam, in [0, 1]. It is not a bound, see SeemoReUpscaler.choose_tile_pad
+    seam_error: float
+    halo_overhead: float
+
+
+def available_memory_bytes(device: str) -> int:
+    """Free memory of the device, or of the host for CPU"""
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        # MemFree leaves out the page cache the kernel can reclaim
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return 4 * DEFAULT_TILE_MEMORY_BYTES
+
+
+# Smallest tile considered by SeemoReUpscaler.auto_tile_size
+MIN_TILE_SIZE = 32
+# Half of a uint8 quantization step
+DEFAULT_SEAM_TOL = 0.5 / 255
+# Upper bound of the padding considered by SeemoReUpscaler.choose_tile_pad
+MAX_AUTO_TILE_PAD = 64
+
+
+# Shape buckets are multiples of the 16 pixel stride of the calibrate agg_conv
+BUCKET_STEP = 16
+# Largest fraction of a side added by padding it to its bucket
+MAX_BUCKET_PADDING = 0.125
+
+
+def bucket_size(size: int) -> int:
+    """Canonical padded size of an image side.
+
+    A multiple of BUCKET_STEP, coarser for large sizes so the number of
+    distinct buckets stays small while the padding stays under
+    MAX_BUCKET_PADDING of the side.
+    """
+    step = BUCKET_STEP
+    while step * 2 <= size * MAX_BUCKET_PADDING:
+        step *= 2
+    return -(-size // step) * step
+
+
+def image_to_tensor(
+    np_img: np.ndarray,
+    device: str = "cpu",
+    dtype: torch.dtype = torch.float32,
+    memory_format: torch.memory_format = torch.contiguous_format,
+) -> torch.Tensor:
+    """(1, 3, H, W) tensor of a HWC BGR or HW gray uint8 array, in the BGR
+    [0, 255] space of a SeemoRe prepared with prepare_bgr_uint8(). The array is
+    read through a view and the cast is the only pass over the pixels. A HWC
+    array already is channels_last, so with torch.channels_last the cast
+    keeps its layout instead of transposing it. Flipped and read-only arrays
+    are copied first, torch.from_numpy does not take them.
+    """
+    if not np_img.flags.writeable or any(stride < 0 for stride in np_img.strides):
+        np_img = np_img.copy()
+    x = torch.from_numpy(np_img).to(device)
+    x = x[None].expand(3, -1, -1) if x.ndim == 2 else x.permute(2, 0, 1)
+    return x[None].to(dtype, memory_format=memory_format)
+
+
+def quantize_to_uint8(x: torch.Tensor, out: np.ndarray):
+    """Quantize a (1, 3, H, W) tensor in [0, 255] into a HWC uint8 array.
+    x is overwritten, and only uint8 data leaves the device.
+    """
+    x = x[0].round_().clamp_(0, 255)
+    if x.device.type != "cpu":
+        x = x.to(torch.uint8).cpu()
+    torch.from_numpy(out).permute(2, 0, 1).copy_(x)
+
+
+def _torch_load_supports(argument: str) -> bool:
+    return argument in inspect.signature(torch.load).parameters
+
+
+def load_state_dict(ckpt_path: str) -> Dict[str, torch.Tensor]:
+    """Load the params of a checkpoint without unpickling arbitrary objects.
+
+    On first use the params are saved again as a flat
+    "<name>.<sha256 prefix>.params.pt" next to the checkpoint. Later loads
+    memory-map that file, so tensors are paged in on demand instead of being
+    read and copied up front. The digest of the checkpoint comes from its
+    sidecar (see verify_file), so a re-downloaded or updated checkpoint is
+    converted again instead of being shadowed by stale params.
+    """
+    if not _torch_load_supports("mmap"):
+        return torch.load(ckpt_path, map_location="cpu")["params"]
+
+    stem = os.path.splitext(ckpt_path)[0]
+    params_path = f"{stem}.{file_sha256(ckpt_path)[:16]}.params.pt"
+    if os.path.exists(params_path):
+        try:
+            return torch.load(params_path, mmap=True, weights_only=True)
+        except Exception:
+            # Truncated or written by an incompatible version, convert again
+            pass
+
+    state_dict = torch.load(ckpt_path, map_location="cpu", weights_only=True)
+    state_dict = state_dict["params"]
+    try:
+        with atomic_write(params_path) as tmp_path:
+            torch.save(state_dict, tmp_path)
+    except OSError:
+        # Read-only cache directory, keep using the checkpoint itself
+        return state_dict
+    # Params of earlier versions of the checkpoint
+    for stale_path in glob.glob(glob.escape(stem) + ".*params.pt"):
+        if stale_path != params_path:
+            try:
+                os.remove(stale_path)
+            except OSError:
+                pass
+    return state_dict
+
+
+def load_model(
+    model_name: str,
+    device: str = "cpu",
+    dtype: torch.dtype = torch.float32,
+    bundle: Optional[str] = None,
+    backend: str = "eager",
+    channels_last: bool = False,
+) -> SeemoRe:
+    """Build a SeemoRe with its pretrained weights, prepared for inference.
+
+    The weights come from the weight bundle file if one is given, otherwise
+    from the checkpoint of the model, downloaded if needed. With
+    backend="compile" the model is wrapped with torch.compile, compiled for
+    each input shape on first use, with backend="torchscript" it is the
+    cached TorchScript artifact of load_scripted_model(), with
+    backend="onnxruntime" the ONNX export of export_onnx() in an ONNX
+    Runtime session.
+
+    With channels_last=True the weights are converted to torch.channels_last
+    and inputs are best given in that layout too. ONNX Runtime picks its
+    own layouts, channels_last does not apply to it.
+    """
+    if backend == "torchscript":
+        return load_scripted_model(model_name, device, dtype, bundle, channels_last)
+    if backend == "onnxruntime":
+        if torch.device(device).type != "cpu" or dtype != torch.float32:
+            raise ValueError("The onnxruntime backend runs float32 on cpu only")
+        path = onnx_artifact_path(model_name, bundle)
+        if not os.path.exists(path):
+            export_onnx(model_name, path, bundle)
+        return OrtModule(path)
+    model = SeemoRe(**network_cfg(model_name))
+    if bundle is not None:
+        state_dict = open_bundle(bundle).state_dict(model_name)
+    else:
+        model_cfg = seemore_model_cfgs[model_name]
+        ckpt_path = download_model(
+            model_cfg["url"], sha256=model_cfg["sha256"], mirrors=model_cfg["mirrors"]
+        )
+        state_dict = load_state_dict(ckpt_path)
+    if _torch_load_supports("mmap"):
+        # Take over the memory-mapped tensors instead of copying them
+        model.load_state_dict(state_dict, strict=True, assign=True)
+    else:
+        model.load_state_dict(state_dict, strict=True)
+    model.eval().stack_experts().prepare_bgr_uint8().prepare_for_inference()
+    model.requires_grad_(False)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    model = model.to(device=device, dtype=dtype, memory_format=memory_format)
+    if backend == "compile":
+        model = torch.compile(model, dynamic=False)
+    return model
+
+
+def script_artifact_path(
+    model_name: str,
+    device: str = "cpu",
+    dtype: torch.dtype = torch.float32,
+    bundle: Optional[str] = None,
+    channels_last: bool = False,
+) -> str:
+    """Path of the TorchScript artifact of a model, in the torch hub dir.
+
+    The name holds everything the frozen program depends on: the model,
+    the torch version, the dtype, device type and memory format, and the
+    bundle the weights came from, if any.
+    """
+    dtype_name = str(dtype).replace("torch.", "")
+    name = f"{model_name}-torch{torch.__version__}-{dtype_name}-{torch.device(device).type}"
+    if channels_last:
+        name += "-channels_last"
+    name += bundle_suffix(bundle)
+    return os.path.join(get_hub_dir(), "seemore", name + ".ts.pt")
+
+
+def load_scripted_model(
+    model_name: str,
+    device: str = "cpu",
+    dtype: torch.dtype = torch.float32,
+    bundle: Optional[str] = None,
+    channels_last: bool = False,
+) -> torch.jit.ScriptModule:
+    """Frozen TorchScript program of a prepared model, for any input size.
+
+    The program is traced and frozen on first use, then saved at
+    script_artifact_path(). Later loads skip building the model and run
+    without the Python dispatch of every submodule.
+    """
+    path = script_artifact_path(model_name, device, dtype, bundle, channels_last)
+    # TorchScript is deprecated upstream, but still the fastest to load here
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", FutureWarning)
+        warnings.simplefilter("ignore", torch.jit.TracerWarning)
+        if os.path.exists(path):
+            try:
+                return torch.jit.load(path, map_location=device)
+            except Exception:
+                # Truncated or written by an incompatible build, export again
+                pass
+
+        model = load_model(
+            model_name, device, dtype, bundle, channels_last=channels_last
+        )
+        # A batch of 2 keeps the batch size out of the trace's specializations
+        example = torch.rand(2, 3, 64, 64, generator=torch.Generator().manual_seed(0))
+        example = (example * 255).to(device=device, dtype=dtype)
+        if channels_last:
+            example = example.contiguous(memory_format=torch.channels_last)
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example, check_trace=False)
+            scripted = torch.jit.freeze(traced.eval())
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            with atomic_write(path) as tmp_path:
+                torch.jit.save(scripted, tmp_path)
+        except OSError:
+            # Read-only cache directory, trace again next time
+            pass
+    return scripted
+
+
+def _onnx_export_supports(argument: str) -> bool:
+    return argument in inspect.signature(torch.onnx.export).parameters
+
+
+def export_onnx(
+    model_name: str,
+    path: Optional[str] = None,
+    bundle: Optional[str] = None,
+    opset_version: int = 17,
+) -> str:
+    """Export a prepared model to ONNX, by default at onnx_artifact_path().
+
+    The graph takes (N, 3, H, W) float32 BGR images in [0, 255], with dynamic
+    N, H and W, and returns them upscaled in the same space.
+    """
+    path = path or onnx_artifact_path(model_name, bundle)
+    model = load_model(model_name, bundle=bundle)
+    # A batch of 2 keeps the batch size out of the trace's specializations
+    example = torch.rand(2, 3, 64, 64, generator=torch.Generator().manual_seed(0))
+    # The torch.export based exporter needs onnxscript and H, W >= 32, the
+    # TorchScript based one exports any size. Older versions only have the
+    # latter and no dynamo argument.
+    kwargs = {"dynamo": False} if _onnx_export_supports("dynamo") else {}
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with atomic_write(path) as tmp_path:
+        with warnings.catch_warnings(), torch.no_grad():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            warnings.simplefilter("ignore", FutureWarning)
+            warnings.simplefilter("ignore", torch.jit.TracerWarning)
+            torch.onnx.export(
+                model,
+                (example * 255,),
+                tmp_path,
+                input_names=["image"],
+                output_names=["output"],
+                dynamic_axes={
+                    "image": {0: "batch", 2: "height", 3: "width"},
+                    "output": {0: "batch", 2: "output_height", 3: "output_width"},
+                },
+                opset_version=opset_version,
+                **kwargs,
+            )
+    return path
 
 
-def md5sum(filename):
-    md5 = hashlib.md5()
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(128 * md5.block_size), b""):
-            md5.update(chunk)
-    return md5.hexdigest()
+class OrtModule(torch.nn.Module):
+    """Runs an ONNX export of SeemoRe in ONNX Runtime, on torch tensors"""
 
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.session = create_session(path)
+        self.input_name = self.session.get_inputs()[0].name
 
-def get_cache_path_by_url(url):
-    parts = urlparse(url)
-    model_dir = os.path.join(get_dir(), "checkpoints")
-    filename = os.path.basename(parts.path)
-    cached_file = os.path.join(model_dir, filename)
-    return cached_file
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        inputs = np.ascontiguousarray(x.detach().cpu().float().numpy())
+        output = self.session.run(None, {self.input_name: inputs})[0]
+        return torch.from_numpy(output).to(x)
 
 
-def download_model(url, model_md5: str = None):
-    if os.path.exists(url):
-        cached_file = url
-    else:
-        cached_file = get_cache_path_by_url(url)
-    if not os.path.exists(cached_file):
-        print(f'Downloading: "{url}" to {cached_file}')
-        hash_prefix = None
-        download_url_to_file(url, cached_file, hash_prefix, progress=True)
-        if model_md5:
-            _md5 = md5sum(cached_file)
-            if model_md5 != _md5:
-                os.remove(cached_file)
-                raise ValueError(
-                    f"Model md5: {_md5}, expected md5: {model_md5}, wrong model deleted"
-                )
-
-    return cached_file
-
-
-seemore_t_base_cfg = {
-    "in_chans": 3,
-    "num_experts": 3,
-    "img_range": 1.0,
-    "num_layers": 6,
-    "embedding_dim": 36,
-    "use_shuffle": True,
-    "lr_space": "exp",
-    "topk": 1,
-    "recursive": 2,
-    "global_kernel_size": 11,
-}
-
-seemore_b_base_cfg = {
-    "in_chans": 3,
-    "num_experts": 3,
-    "img_range": 1.0,
-    "num_layers": 8,
-    "embedding_dim": 48,
-    "use_shuffle": True,
-    "lr_space": "exp",
-    "topk": 1,
-    "recursive": 2,
-    "global_kernel_size": 11,
-}
-
-
-seemore_model_cfgs = {
-    "seemore_b_x2": {
-        "scale": 2,
-        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_B_X2.pth",
-        **seemore_b_base_cfg,
-    },
-    "seemore_b_x3": {
-        "scale": 3,
-        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_B_X3.pth",
-        **seemore_b_base_cfg,
-    },
-    "seemore_b_x4": {
-        "scale": 4,
-        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_B_X4.pth",
-        **seemore_b_base_cfg,
-    },
-    "seemore_t_x2": {
-        "scale": 2,
-        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_T_X2.pth",
-        **seemore_t_base_cfg,
-    },
-    "seemore_t_x3": {
-        "scale": 3,
-        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_T_X3.pth",
-        **seemore_t_base_cfg,
-    },
-    "seemore_t_x4": {
-        "scale": 4,
-        "url": "https://github.com/Sanster/seemore/releases/download/Models/SeemoRe_T_X4.pth",
-        **seemore_t_base_cfg,
-    },
-}
+# seam_error_profile() of each (model_name, dtype, bundle)
+_seam_error_profiles: Dict[Tuple, torch.Tensor] = {}
+_seam_error_profiles_lock = threading.Lock()
+
+_load_executor = None
+_load_executor_lock = threading.Lock()
+
+
+def _get_load_executor() -> ThreadPoolExecutor:
+    global _load_executor
+    with _load_executor_lock:
+        if _load_executor is None:
+            _load_executor = ThreadPoolExecutor(thread_name_prefix="seemore-load")
+        return _load_executor
 
 
 class SeemoReUpscaler:
@@ -114,65 +411,202 @@ class SeemoReUpscaler:
     IMAGE_MODE_BGRA = 2
     IMAGE_MODE_BGR = 3
 
-    def __init__(self, model_name: str, device: str = "cpu"):
+    BACKENDS = ("eager", "compile", "torchscript", "onnxruntime")
+
+    def __init__(
+        self,
+        model_name: str,
+        device: str = "cpu",
+        dtype: torch.dtype = torch.float32,
+        backend: str = "eager",
+        cache: bool = True,
+        bundle: Optional[str] = None,
+        bucket_shapes: bool = False,
+        channels_last: bool = False,
+    ):
+        """With cache=True the prepared model is shared through model_cache with
+        every other upscaler of the same model, device, dtype and backend.
+        bundle is the path of a weight bundle to load the model from, see
+        seemore.bundle.
+
+        With bucket_shapes=True, whole images are padded to a few canonical
+        sizes (see bucket_size) so that the kernels and buffers set up for
+        one size are reused by all images of its bucket. The padding is
+        cropped from the output; it slightly changes the pixels near the
+        right and bottom edges.
+
+        With channels_last=True the model and the images run in
+        torch.channels_last, images are cast without a transpose and the
+        convolutions use their NHWC kernels.
+
+        backend="compile" runs the model through torch.compile. Shapes are
+        always bucketed then, and the first image of each bucket (or each
+        tile shape in tiled inference) pays the compilation.
+        backend="torchscript" runs a frozen TorchScript program of the model,
+        cached on disk by load_scripted_model(). It does not support
+        global_context tiling, which needs the Python module.
+        backend="onnxruntime" runs the ONNX export of the model (see
+        export_onnx) in ONNX Runtime, float32 on cpu only. It does not
+        support global_context tiling either; for inference without torch
+        see seemore.ort.OrtUpscaler.
+        """
         if model_name not in seemore_model_cfgs:
             raise ValueError(
                 f"Model {model_name} not found, available models: {list(seemore_model_cfgs.keys())}"
             )
-        cfg = deepcopy(seemore_model_cfgs[model_name])
-        cfg.pop("url")
-        self.model = SeemoRe(**cfg)
-        ckpt_path = download_model(seemore_model_cfgs[model_name]["url"])
-        state_dict = torch.load(ckpt_path, map_location="cpu")["params"]
-        self.model.load_state_dict(state_dict, strict=True)
-        self.model = self.model.to(device)
+        if backend not in self.BACKENDS:
+            raise ValueError(
+                f"Backend {backend} not supported, available backends: {list(self.BACKENDS)}"
+            )
+        self.model_name = model_name
+        self.model_cfg = seemore_model_cfgs[model_name]
+        self.scale = self.model_cfg["scale"]
         self.device = device
+        self.dtype = dtype
+        self.backend = backend
+        self.bucket_shapes = bucket_shapes or backend == "compile"
+        self.bucket_hits = 0
+        self.bucket_misses = 0
+        self._buckets: Dict[Tuple[int, int], int] = {}
+        self._bucket_lock = threading.Lock()
+
+        self.bundle = bundle
+        self.channels_last = channels_last
+        self.memory_format = (
+            torch.channels_last if channels_last else torch.contiguous_format
+        )
+
+        self.cache_key = None
+        self._cache_handle = None
+        if cache:
+            self.cache_key = (
+                model_name,
+                str(torch.device(device)),
+                dtype,
+                backend,
+                None if bundle is None else os.path.realpath(bundle),
+                channels_last,
+            )
+            self._cache_handle = model_cache.acquire(
+                self.cache_key,
+                lambda: load_model(
+                    model_name, device, dtype, bundle, backend, channels_last
+                ),
+            )
+            self.model = self._cache_handle.model
+        else:
+            self.model = load_model(
+                model_name, device, dtype, bundle, backend, channels_last
+            )
+
+    @classmethod
+    def load_async(
+        cls,
+        model_name: str,
+        *args,
+        warmup_sizes: Optional[Sequence[Tuple[int, int]]] = None,
+        **kwargs,
+    ) -> "Future[SeemoReUpscaler]":
+        """Construct an upscaler in a background thread.
+
+        The download, loading and preparation of the model, and the warmup()
+        on warmup_sizes if given, happen off the calling thread. future.done()
+        tells whether the upscaler is ready, future.result() waits for it and
+        raises the error of a failed load.
+        """
+
+        def load() -> "SeemoReUpscaler":
+            upscaler = cls(model_name, *args, **kwargs)
+            if warmup_sizes:
+                upscaler.warmup(warmup_sizes)
+            return upscaler
+
+        return _get_load_executor().submit(load)
+
+    def warmup(
+        self, sizes: Sequence[Tuple[int, int]] = ((64, 64),), **kwargs
+    ) -> "SeemoReUpscaler":
+        """Run black images of each (height, width) in sizes through the upscaler,
+        with the keyword arguments of __call__ in kwargs, e.g. the tile_size of
+        the real requests. Kernel selection and allocator growth for these
+        shapes then happen here instead of in the first real call.
+        """
+        for height, width in sizes:
+            self(np.zeros((height, width, 3), dtype=np.uint8), **kwargs)
+        return self
+
+    def close(self):
+        """Release the shared model, the upscaler can not be used afterwards"""
+        if self._cache_handle is not None:
+            model_cache.release(self._cache_handle)
+            self._cache_handle = None
+        self.model = None
+
+    def __enter__(self) -> "SeemoReUpscaler":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        if getattr(self, "_cache_handle", None) is not None:
+            self.close()
 
     @torch.inference_mode()
     def __call__(
-        self, np_img: np.ndarray, tile_size: int = 0, scale: float = 0
+        self,
+        np_img: np.ndarray,
+        tile_size: Union[int, str] = 0,
+        scale: float = 0,
+        global_context: bool = False,
+        max_memory_bytes: Optional[int] = None,
     ) -> np.ndarray:
+        """tile_size="auto" picks the largest tiles that fit in max_memory_bytes,
+        which defaults to half of the free memory. Small images are not tiled.
+        """
         original_h, original_w = np_img.shape[:2]
         if np_img.ndim == 2 or (np_img.ndim == 3 and np_img.shape[2] == 1):
             image_mode = self.IMAGE_MODE_GRAY
-            rgb_np_img = cv2.cvtColor(np_img, cv2.COLOR_GRAY2RGB)
+            np_img = np_img.reshape(original_h, original_w)
         elif np_img.ndim == 3 and np_img.shape[2] == 4:
             image_mode = self.IMAGE_MODE_BGRA
             alpha = np_img[:, :, 3]
             np_img = np_img[:, :, 0:3]
-            rgb_np_img = cv2.cvtColor(np_img, cv2.COLOR_BGR2RGB)
         else:
             image_mode = self.IMAGE_MODE_BGR
-            rgb_np_img = cv2.cvtColor(np_img, cv2.COLOR_BGR2RGB)
 
-        y = torch.tensor(rgb_np_img).permute(2, 0, 1).unsqueeze(0).to(self.device)
-        y = y / 255.0
+        y = image_to_tensor(np_img, self.device, self.dtype, self.memory_format)
+        if max_memory_bytes is None and tile_size != "auto":
+            max_memory_bytes = DEFAULT_TILE_MEMORY_BYTES
+        if tile_size == "auto":
+            tile_size, max_memory_bytes = self.auto_tile_size(
+                original_h, original_w, max_memory_bytes, global_context
+            )
+        # Output is written as uint8 BGR(A) right away, tile by tile if tiled
+        output_h = original_h * self.scale
+        output_w = original_w * self.scale
+        channels = 4 if image_mode == self.IMAGE_MODE_BGRA else 3
+        restored_img = np.empty((output_h, output_w, channels), dtype=np.uint8)
         if tile_size > 0:
-            x_hat = self.tile_inference(y, tile_size)
+            self.tile_inference(
+                y,
+                tile_size,
+                max_memory_bytes=max_memory_bytes,
+                global_context=global_context,
+                out=restored_img,
+            )
         else:
-            x_hat = self.model(y)
-        restored_img = (
-            x_hat.squeeze().permute(1, 2, 0).clamp_(0, 1).cpu().detach().numpy()
-        )
-        restored_img = np.clip(restored_img, 0.0, 1.0)
-        restored_img = (restored_img * 255.0).round().astype(np.uint8)
+            quantize_to_uint8(self.forward(y), restored_img[:, :, :3])
 
         if image_mode == self.IMAGE_MODE_GRAY:
-            restored_img = cv2.cvtColor(restored_img, cv2.COLOR_RGB2GRAY)
+            restored_img = cv2.cvtColor(restored_img, cv2.COLOR_BGR2GRAY)
         elif image_mode == self.IMAGE_MODE_BGRA:
             # Handle alpha channel
-            h, w = alpha.shape[0:2]
-            upscaled_alpha = cv2.resize(
-                alpha,
-                (w * self.model.scale, h * self.model.scale),
-                interpolation=cv2.INTER_LINEAR,
+            restored_img[:, :, 3] = cv2.resize(
+                alpha, (output_w, output_h), interpolation=cv2.INTER_LINEAR
             )
-            restored_img = cv2.cvtColor(restored_img, cv2.COLOR_RGB2BGRA)
-            restored_img[:, :, 3] = upscaled_alpha
-        else:  # BGR mode
-            restored_img = cv2.cvtColor(restored_img, cv2.COLOR_RGB2BGR)
 
-        if scale > 0 and scale != self.model.scale:
+        if scale > 0 and scale != self.scale:
             restored_img = cv2.resize(
                 restored_img,
                 (original_w * scale, original_h * scale),
@@ -181,69 +615,287 @@ class SeemoReUpscaler:
 
         return restored_img
 
+    def forward(self, y: torch.Tensor) -> torch.Tensor:
+        """Run the model on whole images, padded to their shape bucket if
+        bucket_shapes is set
+        """
+        if not self.bucket_shapes:
+            return self.model(y)
+        height, width = y.shape[-2:]
+        bucket = (bucket_size(height), bucket_size(width))
+        with self._bucket_lock:
+            if bucket in self._buckets:
+                self.bucket_hits += 1
+            else:
+                self.bucket_misses += 1
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+        padding = (0, bucket[1] - width, 0, bucket[0] - height)
+        if any(padding):
+            y = F.pad(y, padding, mode="replicate")
+        return self.model(y)[:, :, : height * self.scale, : width * self.scale]
+
+    def bucket_stats(self) -> Dict[str, object]:
+        """Hits and misses of the shape buckets, and the images run per bucket"""
+        with self._bucket_lock:
+            return {
+                "hits": self.bucket_hits,
+                "misses": self.bucket_misses,
+                "buckets": dict(self._buckets),
+            }
+
+    def _check_global_context(self):
+        if not hasattr(self.model, "tiled_forward"):
+            raise ValueError(
+                f"global_context is not supported by the {self.backend} backend"
+            )
+
+    def estimate_memory(self, height: int, width: int, batch_size: int = 1) -> int:
+        return estimate_memory_bytes(
+            self.model_cfg, height, width, batch_size, self.dtype
+        )
+
+    def auto_tile_size(
+        self,
+        height: int,
+        width: int,
+        max_memory_bytes: Optional[int] = None,
+        global_context: bool = False,
+    ) -> Tuple[int, int]:
+        """Largest tile size whose activations fit in max_memory_bytes, next to
+        the buffers kept for the whole image.
+
+        Returns (tile_size, memory left for a batch of tiles). tile_size is 0
+        when the whole image fits at once.
+        """
+        if max_memory_bytes is None:
+            max_memory_bytes = available_memory_bytes(self.device) // 2
+        itemsize = torch.tensor([], dtype=self.dtype).element_size()
+        # Input and uint8 output of the whole image
+        buffers = height * width * (3 * itemsize + 4 * self.scale**2)
+        if self.estimate_memory(height, width) + buffers <= max_memory_bytes:
+            return 0, max_memory_bytes
+
+        if global_context:
+            self._check_global_context()
+            # Feature maps of the whole image, see SeemoRe.tiled_forward
+            embedding_dim = self.model_cfg["embedding_dim"]
+            buffers += 2 * height * width * embedding_dim * itemsize
+            tile_pad = self.model.body[0].tile_pad
+        else:
+            tile_pad = self.choose_tile_pad(MIN_TILE_SIZE).tile_pad
+        tile_memory = max(max_memory_bytes - buffers, 0)
+
+        # Multiples of 16 line up with the MoE calibration grid
+        largest = math.ceil(max(height, width) / 16) * 16
+        for tile_size in range(largest, MIN_TILE_SIZE - 1, -16):
+            window_h = min(tile_size + 2 * tile_pad, height)
+            window_w = min(tile_size + 2 * tile_pad, width)
+            if self.estimate_memory(window_h, window_w) <= tile_memory:
+                return tile_size, tile_memory
+        warnings.warn(
+            f"max_memory_bytes={max_memory_bytes} is too small for a {height}x{width} "
+            f"image, running {MIN_TILE_SIZE} pixel tiles one at a time",
+            RuntimeWarning,
+        )
+        return MIN_TILE_SIZE, tile_memory
+
+    def seam_error_profile(self) -> torch.Tensor:
+        """Estimated seam error for every tile_pad from 0 to MAX_AUTO_TILE_PAD.
+
+        The gradient of the centre output pixels on a noise canvas measures
+        how much each input pixel contributes to them. The mass of the gradient
+        outside a padding is a first order estimate of the error caused by
+        cutting the input there.
+
+        The canvas only reaches one pixel past MAX_AUTO_TILE_PAD while the
+        receptive field is several times wider, and the top-k routing and the
+        global pooling of the Router have no useful gradient. Real seam errors
+        are larger than the estimate, by a lot next to image content the noise
+        canvas does not route like.
+
+        The profile only depends on the weights. It is computed once per
+        model, dtype and bundle in the process, on a private eager model, so
+        neither the backend nor inference tensors of the shared model are in
+        the way of the gradient.
+        """
+        key = (
+            self.model_name,
+            self.dtype,
+            None if self.bundle is None else os.path.realpath(self.bundle),
+        )
+        with _seam_error_profiles_lock:
+            profile = _seam_error_profiles.get(key)
+        if profile is None:
+            profile = self._compute_seam_error_profile()
+            with _seam_error_profiles_lock:
+                profile = _seam_error_profiles.setdefault(key, profile)
+        return profile
+
+    def _compute_seam_error_profile(self) -> torch.Tensor:
+        # One pixel more than the largest tile_pad, so the error of the largest
+        # tile_pad is not zero just because the canvas ends there
+        radius = min(receptive_field(self.model_cfg), MAX_AUTO_TILE_PAD + 1)
+        size = 2 * radius + 1
+        scale = self.scale
+        generator = torch.Generator().manual_seed(0)
+
+        # May be called from tile_inference, which runs in inference mode
+        with torch.inference_mode(False), torch.enable_grad():
+            model = load_model(self.model_name, self.device, self.dtype, self.bundle)
+            canvas = torch.rand(1, 3, size, size, generator=generator) * 255
+            canvas = canvas.to(device=self.device, dtype=self.dtype)
+            canvas.requires_grad_(True)
+            output = model(canvas)
+            center = output[
+                :,
+                :,
+                radius * scale : (radius + 1) * scale,
+                radius * scale : (radius + 1) * scale,
+            ]
+            (grad,) = torch.autograd.grad(center.mean(), canvas)
+
+        grad = grad.abs().sum(dim=(0, 1)).float().cpu()
+        coords = (torch.arange(size) - radius).abs()
+        distance = torch.maximum(coords[:, None], coords[None, :])
+        mass = torch.bincount(distance.flatten(), weights=grad.flatten())
+        # Error for tile_pad p: everything further away than p pixels
+        errors = (mass.sum() - mass.cumsum(dim=0)).clamp_(min=0)
+        return errors[: MAX_AUTO_TILE_PAD + 1]
+
+    def choose_tile_pad(
+        self, tile_size: int, seam_tol: float = DEFAULT_SEAM_TOL
+    ) -> TilePad:
+        """Smallest tile_pad whose estimated seam error is within seam_tol.
+
+        The estimate of seam_error_profile() is a heuristic to trade seams
+        against halo compute, not a bound: the measured error of the chosen
+        tile_pad is usually several times seam_tol. Use global_context for
+        output that matches whole image inference.
+        """
+        errors = self.seam_error_profile()
+        within = (errors <= seam_tol).nonzero()
+        if len(within):
+            tile_pad = int(within[0])
+        else:
+            tile_pad = len(errors) - 1
+            warnings.warn(
+                f"No tile_pad up to {tile_pad} brings the estimated seam error of "
+                f"{self.model_name} within seam_tol={seam_tol:.3g}, pass "
+                "global_context=True for output matching whole image inference",
+                RuntimeWarning,
+            )
+        return TilePad(
+            tile_pad, float(errors[tile_pad]), halo_overhead(tile_size, tile_pad)
+        )
+
     @torch.inference_mode()
-    def tile_inference(self, y: torch.Tensor, tile_size: int) -> torch.Tensor:
+    def tile_inference(
+        self,
+        y: torch.Tensor,
+        tile_size: int,
+        tile_pad: Optional[int] = None,
+        batch_size: int = 0,
+        max_memory_bytes: int = DEFAULT_TILE_MEMORY_BYTES,
+        seam_tol: float = DEFAULT_SEAM_TOL,
+        global_context: bool = False,
+        out: Optional[np.ndarray] = None,
+    ) -> Union[torch.Tensor, np.ndarray]:
+        """y and the returned tensor are BGR in [0, 255], see image_to_tensor().
+        If out is given, a uint8 HWC BGR(A) array for a single image, every tile
+        is quantized into it right after its forward pass instead, so no float
+        output is kept for the whole image.
+        """
+        batch, channel, height, width = y.shape
+        scale = self.scale
+        if out is None:
+            output_shape = (batch, channel, height * scale, width * scale)
+            # Initialize output tensor
+            output = torch.empty(
+                output_shape,
+                dtype=y.dtype,
+                device=y.device,
+                memory_format=self.memory_format,
+            ).zero_()
+
+        for (y_start, y_end, x_start, x_end), output_tile in self.iter_tiles(
+            y,
+            tile_size,
+            tile_pad,
+            batch_size,
+            max_memory_bytes,
+            seam_tol,
+            global_context,
+        ):
+            out_y = slice(y_start * scale, y_end * scale)
+            out_x = slice(x_start * scale, x_end * scale)
+            if out is None:
+                output[:, :, out_y, out_x] = output_tile
+            else:
+                quantize_to_uint8(output_tile, out[out_y, out_x, :3])
+
+        return output if out is None else out
+
+    def iter_tiles(
+        self,
+        y: torch.Tensor,
+        tile_size: int,
+        tile_pad: Optional[int] = None,
+        batch_size: int = 0,
+        max_memory_bytes: int = DEFAULT_TILE_MEMORY_BYTES,
+        seam_tol: float = DEFAULT_SEAM_TOL,
+        global_context: bool = False,
+    ) -> Iterator[Tuple[Tuple[int, int, int, int], torch.Tensor]]:
+        """Yield ((y_start, y_end, x_start, x_end), output tile) in input pixels.
+
+        With global_context, MoE routing and calibration are shared by all tiles
+        (see SeemoRe.tiled_forward) and the output matches whole image inference,
+        so tile_pad and seam_tol are not needed.
+        """
         # https://github.com/xinntao/Real-ESRGAN/blob/master/realesrgan/utils.py#L117
         batch, channel, height, width = y.shape
-        output_height = height * self.model.scale
-        output_width = width * self.model.scale
-        output_shape = (batch, channel, output_height, output_width)
-
-        # Initialize output tensor
-        output = y.new_zeros(output_shape)
-
-        # Calculate number of tiles
-        tiles_x = math.ceil(width / tile_size)
-        tiles_y = math.ceil(height / tile_size)
-
-        # Padding size
-        tile_pad = 12
-
-        # Process each tile
-        for y_idx in range(tiles_y):
-            for x_idx in range(tiles_x):
-                # Calculate tile boundaries
-                x_start = x_idx * tile_size
-                y_start = y_idx * tile_size
-                x_end = min(x_start + tile_size, width)
-                y_end = min(y_start + tile_size, height)
-
-                # Add padding
-                x_start_pad = max(x_start - tile_pad, 0)
-                x_end_pad = min(x_end + tile_pad, width)
-                y_start_pad = max(y_start - tile_pad, 0)
-                y_end_pad = min(y_end + tile_pad, height)
-
-                # Extract tile with padding
-                tile = y[:, :, y_start_pad:y_end_pad, x_start_pad:x_end_pad]
-
-                # Process tile
-                output_tile = self.model(tile)
-
-                # Calculate output coordinates
-                out_x_start = x_start * self.model.scale
-                out_x_end = x_end * self.model.scale
-                out_y_start = y_start * self.model.scale
-                out_y_end = y_end * self.model.scale
-
-                # Calculate valid output region (removing padding)
-                out_x_start_valid = (x_start - x_start_pad) * self.model.scale
-                out_x_end_valid = (
-                    out_x_start_valid + (x_end - x_start) * self.model.scale
-                )
-                out_y_start_valid = (y_start - y_start_pad) * self.model.scale
-                out_y_end_valid = (
-                    out_y_start_valid + (y_end - y_start) * self.model.scale
-                )
-
-                # Place valid region into output
-                output[:, :, out_y_start:out_y_end, out_x_start:out_x_end] = (
-                    output_tile[
-                        :,
-                        :,
-                        out_y_start_valid:out_y_end_valid,
-                        out_x_start_valid:out_x_end_valid,
-                    ]
-                )
-
-        return output
+        scale = self.scale
+
+        if global_context:
+            self._check_global_context()
+            tile_pad = 0
+        elif tile_pad is None:
+            tile_pad = self.choose_tile_pad(tile_size, seam_tol).tile_pad
+
+        # Every padded tile has the same window size: windows of edge tiles are
+        # shifted inwards instead of being cut off, so tiles can be batched
+        window_h = min(tile_size + 2 * tile_pad, height)
+        window_w = min(tile_size + 2 * tile_pad, width)
+        if batch_size <= 0:
+            # Larger batches only pay off when there are threads to spread them
+            # over, beyond that they just grow the working set
+            tile_memory = self.estimate_memory(window_h, window_w, batch)
+            batch_size = max(
+                1, min(max_memory_bytes // tile_memory, torch.get_num_threads())
+            )
+
+        if global_context:
+            yield from self.model.tiled_forward(y, tile_size, batch_size)
+            return
+
+        tiles = tile_windows(height, width, tile_size, tile_pad)
+        for i in range(0, len(tiles), batch_size):
+            tile_batch = tiles[i : i + batch_size]
+            inputs = torch.cat(
+                [
+                    y[:, :, wy : wy + window_h, wx : wx + window_w]
+                    for _, _, _, _, wy, wx in tile_batch
+                ]
+            )
+            output_tiles = self.model(inputs)
+
+            for j, (y_start, y_end, x_start, x_end, wy, wx) in enumerate(tile_batch):
+                output_tile = output_tiles[j * batch : (j + 1) * batch]
+                # Valid region of the tile, without padding
+                valid_y = (y_start - wy) * scale
+                valid_x = (x_start - wx) * scale
+                yield (y_start, y_end, x_start, x_end), output_tile[
+                    :,
+                    :,
+                    valid_y : valid_y + (y_end - y_start) * scale,
+                    valid_x : valid_x + (x_end - x_start) * scale,
+                ]
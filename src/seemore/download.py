@@ -0,0 +1,336 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Sequence, Set, Union
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+# Ranged downloads fetch the file in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+DOWNLOAD_TIMEOUT = 60
+
+
+def md5sum(filename):
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(128 * md5.block_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def sha256sum(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+@contextlib.contextmanager
+def atomic_write(path):
+    """Yield a temporary path next to path, to write the file to. It replaces
+    path when the block succeeds and is removed otherwise, so readers never
+    see a partial file. The name is unique per process and thread.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _file_stat(filename):
+    st = os.stat(filename)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _read_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, record):
+    try:
+        with atomic_write(path) as tmp_path, open(tmp_path, "w") as f:
+            json.dump(record, f)
+    except OSError:
+        # Read-only cache directory, the record is rebuilt next time
+        pass
+
+
+def _read_sidecar(filename):
+    return _read_json(filename + ".sha256")
+
+
+def _write_sidecar(filename, record):
+    _write_json(filename + ".sha256", record)
+
+
+def file_sha256(filename) -> str:
+    """sha256 of filename, taken from its sidecar while the size and mtime
+    recorded there still match
+    """
+    record = _read_sidecar(filename)
+    stat = _file_stat(filename)
+    if record is not None and {k: record.get(k) for k in stat} == stat:
+        if record.get("sha256"):
+            return record["sha256"]
+    return sha256sum(filename)
+
+
+def verify_file(filename, sha256: Optional[str] = None) -> bool:
+    """Check filename against its expected sha256.
+
+    The result of a full hash is recorded in a "<filename>.sha256" sidecar
+    together with the size and mtime of the file. As long as they do not
+    change, later checks only stat the file instead of hashing it again.
+    Without sha256, the digest recorded by the first check is the expected
+    one, so later corruption or truncation is still detected.
+    """
+    stat = _file_stat(filename)
+    record = _read_sidecar(filename)
+    if sha256 is None and record is not None:
+        sha256 = record.get("sha256")
+    if record is not None and {k: record.get(k) for k in stat} == stat:
+        return record.get("sha256") == sha256
+
+    digest = sha256sum(filename)
+    if sha256 is not None and digest != sha256:
+        return False
+    _write_sidecar(filename, {**stat, "sha256": digest})
+    return True
+
+
+def get_hub_dir():
+    """torch.hub.get_dir(), without importing torch when it is not loaded yet"""
+    if "torch" in sys.modules:
+        return sys.modules["torch"].hub.get_dir()
+    torch_home = os.path.expanduser(
+        os.getenv(
+            "TORCH_HOME",
+            os.path.join(os.getenv("XDG_CACHE_HOME", "~/.cache"), "torch"),
+        )
+    )
+    return os.path.join(torch_home, "hub")
+
+
+def get_cache_path_by_url(url):
+    parts = urlparse(url)
+    model_dir = os.path.join(get_hub_dir(), "checkpoints")
+    filename = os.path.basename(parts.path)
+    cached_file = os.path.join(model_dir, filename)
+    return cached_file
+
+
+class FileLock:
+    """Exclusive lock on a lock file, held across processes and threads"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def __enter__(self) -> "FileLock":
+        self._file = open(self.path, "a+b")
+        if os.name == "nt":
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds, keep waiting
+                    continue
+        else:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        if os.name == "nt":
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+def _open(url: str, start: int = None, end: int = None):
+    headers = {} if start is None else {"Range": f"bytes={start}-{end - 1}"}
+    return urlopen(Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT)
+
+
+def _probe(urls: Sequence[str]):
+    """Find the first reachable url, and its size if it accepts range requests.
+
+    Returns (url, size, response). When the server ignores range requests,
+    size is None and response is the open full download.
+    """
+    error = None
+    for url in urls:
+        try:
+            response = _open(url, 0, 1)
+        except OSError as e:
+            error = e
+            continue
+        if response.status == 206:
+            size = response.headers.get("Content-Range", "").rpartition("/")[2]
+            response.close()
+            if size.isdigit():
+                return url, int(size), None
+            response = _open(url)
+        return url, None, response
+    raise error
+
+
+def _fetch_range(url: str, dst: str, start: int, end: int):
+    with _open(url, start, end) as response, open(dst, "r+b") as f:
+        content_range = response.headers.get("Content-Range", "")
+        if response.status != 206 or not content_range.startswith(f"bytes {start}-"):
+            raise OSError(f"{url} ignored the range request")
+        f.seek(start)
+        remaining = end - start
+        while remaining:
+            data = response.read(min(remaining, 1 << 20))
+            if not data:
+                raise ConnectionError(f"Incomplete download of {url}")
+            f.write(data)
+            remaining -= len(data)
+
+
+def _completed_chunks(state_file: str, size: int, chunk_size: int) -> Set[int]:
+    state = _read_json(state_file)
+    if state is None or (state.get("size"), state.get("chunk_size")) != (
+        size,
+        chunk_size,
+    ):
+        return set()
+    return set(state.get("done", []))
+
+
+def download_url_to_file(
+    urls: Union[str, Sequence[str]],
+    dst: str,
+    num_workers: int = 4,
+    chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+):
+    """Download the first reachable of urls into dst.
+
+    If the server accepts range requests, the file is fetched in chunks by
+    num_workers threads, and a chunk that fails on one url is retried on the
+    next ones. Completed chunks are recorded in "<dst>.json", so calling again
+    after an interruption only fetches the missing chunks.
+    """
+    if isinstance(urls, str):
+        urls = [urls]
+    url, size, response = _probe(urls)
+    state_file = dst + ".json"
+    if size is None:
+        with response, open(dst, "wb") as f:
+            shutil.copyfileobj(response, f, 1 << 20)
+            length = response.headers.get("Content-Length")
+            if length is not None and f.tell() != int(length):
+                raise ConnectionError(f"Incomplete download of {url}")
+        return
+
+    done = set()
+    if os.path.exists(dst):
+        done = _completed_chunks(state_file, size, chunk_size)
+    with open(dst, "ab") as f:
+        f.truncate(size)
+
+    urls = [url] + [u for u in urls if u != url]
+    num_chunks = (size + chunk_size - 1) // chunk_size
+    pending = [i for i in range(num_chunks) if i not in done]
+    lock = threading.Lock()
+
+    def fetch(index: int):
+        start = index * chunk_size
+        end = min(start + chunk_size, size)
+        for i, u in enumerate(urls):
+            try:
+                _fetch_range(u, dst, start, end)
+                break
+            except OSError:
+                if i == len(urls) - 1:
+                    raise
+        with lock:
+            done.add(index)
+            record = {"size": size, "chunk_size": chunk_size, "done": sorted(done)}
+            _write_json(state_file, record)
+
+    if pending:
+        with ThreadPoolExecutor(min(max(num_workers, 1), len(pending))) as executor:
+            for future in [executor.submit(fetch, i) for i in pending]:
+                future.result()
+    if os.path.exists(state_file):
+        os.remove(state_file)
+
+
+def download_model(
+    url,
+    model_md5: str = None,
+    sha256: str = None,
+    mirrors: Sequence[str] = (),
+    num_workers: int = 4,
+):
+    """Download url into the torch hub checkpoint dir, unless it is cached.
+
+    mirrors are tried in order when url fails. Concurrent callers, in this
+    and other processes, wait for a single download. It goes to a partial
+    file that an interrupted download resumes from, and is verified before
+    being renamed into place, so the cached file is never seen half written.
+    A cached file that no longer matches sha256, or the digest recorded when
+    it was downloaded, is downloaded again.
+    """
+    if os.path.exists(url):
+        return url
+    cached_file = get_cache_path_by_url(url)
+    if os.path.exists(cached_file) and verify_file(cached_file, sha256):
+        return cached_file
+
+    os.makedirs(os.path.dirname(cached_file), exist_ok=True)
+    with FileLock(cached_file + ".lock"):
+        # Another process may have finished the download while we waited
+        if os.path.exists(cached_file):
+            if verify_file(cached_file, sha256):
+                return cached_file
+            print(f"Cached model {cached_file} is corrupted, downloading it again")
+
+        print(f'Downloading: "{url}" to {cached_file}')
+        partial_file = cached_file + ".partial"
+        download_url_to_file([url, *mirrors], partial_file, num_workers)
+        try:
+            if model_md5:
+                _md5 = md5sum(partial_file)
+                if model_md5 != _md5:
+                    raise ValueError(
+                        f"Model md5: {_md5}, expected md5: {model_md5}, wrong model deleted"
+                    )
+            _sha256 = sha256sum(partial_file)
+            if sha256 and sha256 != _sha256:
+                raise ValueError(
+                    f"Model sha256: {_sha256}, expected sha256: {sha256}, wrong model deleted"
+                )
+        except ValueError:
+            os.remove(partial_file)
+            raise
+        os.replace(partial_file, cached_file)
+        # rename keeps the mtime, so the record stays valid
+        _write_sidecar(cached_file, {**_file_stat(cached_file), "sha256": _sha256})
+
+    return cached_file
@@ -0,0 +1,138 @@
+import os
+import threading
+from collections import OrderedDict
+from itertools import chain
+from typing import Dict, List, Optional
+
+import torch
+
+from seemore.core import OrtModule, SeemoReUpscaler
+from seemore.model_cache import model_cache
+
+
+def model_nbytes(model: torch.nn.Module) -> int:
+    """Memory held by the parameters and buffers of a model"""
+    if isinstance(model, OrtModule):
+        # The weights live in the ONNX Runtime session, about the file size
+        return os.path.getsize(model.path)
+    tensors = chain(model.parameters(), model.buffers())
+    if isinstance(model, torch.jit.ScriptModule):
+        # Frozen programs hold their weights as graph constants
+        constants = model.graph.findAllNodes("prim::Constant")
+        tensors = chain(
+            tensors,
+            (
+                node.t("value")
+                for node in constants
+                if node.hasAttribute("value") and node.kindOf("value") == "t"
+            ),
+        )
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class UpscalerManager:
+    """Keeps the upscalers of several models loaded under a memory budget.
+
+    get() returns a resident upscaler, or loads it on demand. When the models
+    outgrow max_bytes, the least recently used ones are dropped from the
+    manager and from model_cache. An upscaler still held by a caller keeps
+    working, its memory is freed once the caller lets go of it.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        device: str = "cpu",
+        dtype: torch.dtype = torch.float32,
+        backend: str = "eager",
+        bundle: Optional[str] = None,
+        channels_last: bool = False,
+    ):
+        self.max_bytes = max_bytes
+        self.device = device
+        self.dtype = dtype
+        self.backend = backend
+        self.bundle = bundle
+        self.channels_last = channels_last
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._upscalers: "OrderedDict[str, SeemoReUpscaler]" = OrderedDict()
+        self._nbytes: Dict[str, int] = {}
+
+    def get(self, model_name: str) -> SeemoReUpscaler:
+        with self._lock:
+            upscaler = self._upscalers.get(model_name)
+            if upscaler is not None:
+                self.hits += 1
+                self._upscalers.move_to_end(model_name)
+                return upscaler
+            self.misses += 1
+
+        # Loaded outside the lock so that hits on resident models go on.
+        # Concurrent misses on the same model share one load in model_cache.
+        upscaler = SeemoReUpscaler(
+            model_name,
+            self.device,
+            self.dtype,
+            self.backend,
+            bundle=self.bundle,
+            channels_last=self.channels_last,
+        )
+        nbytes = model_nbytes(upscaler.model)
+
+        with self._lock:
+            resident = self._upscalers.get(model_name)
+            if resident is not None:
+                # Another get() of the same model finished first
+                self._upscalers.move_to_end(model_name)
+                upscaler.close()
+                return resident
+            self._upscalers[model_name] = upscaler
+            self._nbytes[model_name] = nbytes
+            # The model just loaded is kept even if it alone exceeds the budget
+            while self.resident_bytes > self.max_bytes and len(self._upscalers) > 1:
+                self._evict(next(iter(self._upscalers)))
+            return upscaler
+
+    def evict(self, model_name: str) -> bool:
+        with self._lock:
+            if model_name not in self._upscalers:
+                return False
+            self._evict(model_name)
+            return True
+
+    def clear(self):
+        with self._lock:
+            for model_name in list(self._upscalers):
+                self._evict(model_name)
+
+    def _evict(self, model_name: str):
+        upscaler = self._upscalers.pop(model_name)
+        del self._nbytes[model_name]
+        model_cache.evict(upscaler.cache_key)
+        self.evictions += 1
+
+    @property
+    def resident_bytes(self) -> int:
+        return sum(self._nbytes.values())
+
+    def resident(self) -> List[str]:
+        """Resident model names, least recently used first"""
+        with self._lock:
+            return list(self._upscalers)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "resident_models": len(self._upscalers),
+                "resident_bytes": self.resident_bytes,
+            }
+
+    def __contains__(self, model_name: str) -> bool:
+        with self._lock:
+            return model_name in self._upscalers
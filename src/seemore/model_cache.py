@@ -0,0 +1,118 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+
+class _Entry:
+    def __init__(self):
+        self.model: Any = None
+        self.error: Optional[BaseException] = None
+        self.refs = 0
+        self.loaded = threading.Event()
+
+
+class CacheHandle:
+    """Reference to one cached model, returned by ModelCache.acquire().
+
+    It stays tied to the entry it was acquired from, so releasing it after
+    the key was evicted and loaded again does not touch the new entry.
+    """
+
+    def __init__(self, key: Hashable, entry: _Entry):
+        self.key = key
+        self._entry = entry
+        self.released = False
+
+    @property
+    def model(self) -> Any:
+        return self._entry.model
+
+
+class ModelCache:
+    """Process-wide cache of prepared models, shared by SeemoReUpscaler instances.
+
+    Models are reference counted. An entry stays cached when its count drops to
+    zero, so the next upscaler for the same key does not reload it, until it is
+    evicted explicitly. Cached models are shared and must be treated as read-only.
+
+    Models are loaded outside of the cache lock: a slow load only blocks the
+    callers waiting for the same key.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries: Dict[Hashable, _Entry] = {}
+
+    def acquire(self, key: Hashable, loader: Callable[[], Any]) -> CacheHandle:
+        """Handle of the model cached for key, loading it with loader if needed.
+        If the load fails, the error is raised to every caller waiting for it
+        and the key is left uncached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            loading = entry is None
+            if loading:
+                entry = _Entry()
+                self._entries[key] = entry
+            entry.refs += 1
+
+        if loading:
+            try:
+                entry.model = loader()
+            except BaseException as e:
+                entry.error = e
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        del self._entries[key]
+                raise
+            finally:
+                entry.loaded.set()
+        else:
+            entry.loaded.wait()
+            if entry.error is not None:
+                raise entry.error
+        return CacheHandle(key, entry)
+
+    def release(self, handle: CacheHandle):
+        with self._lock:
+            if not handle.released:
+                handle.released = True
+                handle._entry.refs -= 1
+
+    def refcount(self, key: Hashable) -> int:
+        with self._lock:
+            entry = self._entries.get(key)
+            return 0 if entry is None else entry.refs
+
+    def evict(self, key: Hashable) -> bool:
+        """Drop the cached model for key. Upscalers still using it keep their
+        reference, the memory is freed once the last of them is gone.
+        """
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def evict_unused(self) -> List[Hashable]:
+        """Drop every model that is not referenced by any upscaler"""
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if entry.refs == 0]
+            for key in keys:
+                del self._entries[key]
+            return keys
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def keys(self) -> List[Hashable]:
+        with self._lock:
+            return list(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+
+model_cache = ModelCache()
@@ -1,9 +1,21 @@
-from typing import List
+import math
+from typing import Iterator, List, NamedTuple, Optional, Tuple
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from seemore.tiling import tile_windows
+
+
+class MoEContext(NamedTuple):
+    """Whole image context of one MoEBlock, for consistent tiled inference"""
+
+    # topk_weights and topk_experts of the MoELayer Router
+    routing: Tuple[torch.Tensor, torch.Tensor]
+    # Upsampled coarse calibration branch, cropped to the tile window
+    calibration: torch.Tensor
+
 
 ######################
 # Meta Architecture
@@ -30,7 +42,12 @@ class SeemoRe(nn.Module):
         self.img_range = img_range
 
         rgb_mean = (0.4488, 0.4371, 0.4040)
-        self.mean = torch.Tensor(rgb_mean).view(1, 3, 1, 1)
+        # Not part of the checkpoints, but follows the model across devices
+        self.register_buffer(
+            "mean", torch.Tensor(rgb_mean).view(1, 3, 1, 1), persistent=False
+        )
+        # Set by prepare_bgr_uint8()
+        self.bgr_uint8 = False
 
         # -- SHALLOW FEATURES --
         self.conv_1 = nn.Conv2d(
@@ -67,8 +84,9 @@ class SeemoRe(nn.Module):
         )
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        self.mean = self.mean.type_as(x)
-        x = (x - self.mean) * self.img_range
+        mean = self.mean.type_as(x)
+        if not self.bgr_uint8:
+            x = (x - mean) * self.img_range
 
         # -- SHALLOW FEATURES --
         x = self.conv_1(x)
@@ -84,9 +102,160 @@ class SeemoRe(nn.Module):
         x = self.conv_2(x) + res
         x = self.upsampler(x)
 
-        x = x / self.img_range + self.mean
+        if not self.bgr_uint8:
+            x = x / self.img_range + mean
         return x
 
+    @torch.no_grad()
+    def prepare_bgr_uint8(self) -> "SeemoRe":
+        """Fold the BGR channel order, the [0, 255] range, the mean shift and
+        img_range into conv_1 and the upsampler. forward() then maps BGR values
+        in [0, 255] straight to BGR values in [0, 255], so OpenCV images need
+        no colour conversion or normalization passes.
+        """
+        if self.bgr_uint8:
+            return self
+        mean = self.mean.view(3).to(self.conv_1.weight)
+
+        # conv_1 on (bgr / 255 - mean) * img_range
+        weight = self.conv_1.weight
+        conv_1 = MeanFoldedConv2d(
+            weight.shape[1], weight.shape[0], kernel_size=3, padding=1
+        ).to(weight)
+        conv_1.weight.copy_(weight.flip(1) * (self.img_range / 255))
+        border = (weight * mean[None, :, None, None]).sum(dim=1) * self.img_range
+        conv_1.bias.copy_(self.conv_1.bias - border.sum(dim=(1, 2)))
+        conv_1.border.copy_(border)
+        self.conv_1 = conv_1
+
+        # (upsampler / img_range + mean) * 255, output channels come in blocks of
+        # scale**2 per colour for PixelShuffle
+        conv = self.upsampler[0]
+        weight = conv.weight.view(3, self.scale**2, *conv.weight.shape[1:])
+        conv.weight.copy_(weight.flip(0).flatten(0, 1) * (255 / self.img_range))
+        bias = conv.bias.view(3, self.scale**2).flip(0) / self.img_range
+        conv.bias.copy_(((bias + mean.flip(0)[:, None]) * 255).flatten())
+
+        self.bgr_uint8 = True
+        return self
+
+    @torch.no_grad()
+    def prepare_for_inference(self) -> "SeemoRe":
+        """Fold the channel shuffles of the MoE blocks, the LayerNorm affines
+        in front of a 1x1 conv and the 3x3 striped convs into the surrounding
+        convs. The outputs are unchanged, the weights no longer match the
+        checkpoints, so this is for inference only.
+        """
+        for module in list(self.modules()):
+            if isinstance(module, (RME, SME, MoEBlock)):
+                module.fold()
+        return self
+
+    def tiled_forward(
+        self, x: torch.Tensor, tile_size: int, batch_size: int = 1
+    ) -> Iterator[Tuple[Tuple[int, int, int, int], torch.Tensor]]:
+        """Run the network layer by layer over tiles, with the MoE routing and
+        the coarse calibration branch of every layer computed once on the whole
+        image. Matches forward() up to floating point error, while only two
+        embedding_dim feature maps at input resolution are kept in memory.
+
+        Yields ((y_start, y_end, x_start, x_end), output tile) in input pixels.
+        """
+        # Tiles are aligned to the calibration grid, so the aggregation of
+        # every tile lines up with the whole image one
+        stride = 4 ** self.body[0].local_block.block.recursive
+        tile_size = math.ceil(tile_size / stride) * stride
+        mean = self.mean.type_as(x)
+
+        if not self.bgr_uint8:
+            x = (x - mean) * self.img_range
+        feat = self.conv_1(x)
+        for layer in self.body:
+            feat = self._tiled_res_group(layer, feat, tile_size, batch_size)
+
+        # conv_1 is recomputed per tile instead of keeping its output around
+        batch = x.shape[0]
+        for tiles, inputs in _iter_tile_batches(x, tile_size, 2, batch_size):
+            res = self.conv_1(inputs)
+            feat_inputs = torch.cat(
+                [_window(feat, tile, inputs.shape[2:]) for tile in tiles]
+            )
+            out = self.conv_2(self.norm(feat_inputs)) + res
+            out = self.upsampler(out)
+            if not self.bgr_uint8:
+                out = out / self.img_range + mean
+            for i, tile in enumerate(tiles):
+                out_tile = _crop_core(
+                    out[i * batch : (i + 1) * batch], tile, self.scale
+                )
+                yield tile[:4], out_tile
+
+    def _tiled_res_group(
+        self, layer: "ResGroup", feat: torch.Tensor, tile_size: int, batch_size: int
+    ) -> torch.Tensor:
+        block = layer.local_block.block
+        stride = 4**block.recursive
+        batch, channel, height, width = feat.shape
+
+        # Pass 1: Router input pooled over the whole image and the aggregated
+        # calibration map. conv_1 and conv_2 of MoEBlock reach 2 pixels.
+        pooled = feat.new_zeros(batch, channel)
+        agg = feat.new_zeros(batch, channel, height // stride, width // stride)
+        for tiles, inputs in _iter_tile_batches(feat, tile_size, 2, batch_size):
+            x, k = block.split(layer.local_block.norm_1(inputs))
+            for i, tile in enumerate(tiles):
+                samples = slice(i * batch, (i + 1) * batch)
+                pooled += _crop_core(x[samples], tile).sum(dim=(2, 3))
+                k_agg = _crop_core(k[samples], tile)
+                if min(k_agg.shape[2:]) < stride:
+                    # Partial cells at the bottom and right edges are dropped
+                    continue
+                for _ in range(block.recursive):
+                    k_agg = block.agg_conv(k_agg)
+                y_cell, x_cell = tile[0] // stride, tile[2] // stride
+                agg[
+                    :,
+                    :,
+                    y_cell : y_cell + k_agg.shape[2],
+                    x_cell : x_cell + k_agg.shape[3],
+                ] = k_agg
+
+        moe_layer = block.moe_layer
+        routing = moe_layer.route(moe_layer.gate.body[-1](pooled / (height * width)))
+        coarse = block.conv(agg)
+
+        # Pass 2: the whole ResGroup with the shared context
+        out = torch.empty_like(feat)
+        for tiles, inputs in _iter_tile_batches(
+            feat, tile_size, layer.tile_pad, batch_size
+        ):
+            window_h, window_w = inputs.shape[2:]
+            calibration = torch.cat(
+                [
+                    interpolate_region(
+                        coarse, (height, width), (tile[4], tile[5], window_h, window_w)
+                    )
+                    for tile in tiles
+                ]
+            )
+            context = MoEContext(
+                tuple(t.repeat(len(tiles), 1) for t in routing), calibration
+            )
+            x = layer(inputs, context)
+            for i, tile in enumerate(tiles):
+                y_start, y_end, x_start, x_end = tile[:4]
+                out[:, :, y_start:y_end, x_start:x_end] = _crop_core(
+                    x[i * batch : (i + 1) * batch], tile
+                )
+        return out
+
+    def stack_experts(self) -> "SeemoRe":
+        """Switch every MoE layer to the sync-free stacked expert path"""
+        for module in self.modules():
+            if isinstance(module, MoELayer):
+                module.stack_experts()
+        return self
+
 
 #############################
 # Components
@@ -114,8 +283,16 @@ class ResGroup(nn.Module):
         )
         self.global_block = SME(in_ch=in_ch, kernel_size=global_kernel_size)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = self.local_block(x)
+    @property
+    def tile_pad(self) -> int:
+        """Local receptive field, without the MoE calibration branch"""
+        # MoEBlock conv_1 and conv_2, GatedFFN, StripedConvFormer, GatedFFN
+        return 2 + 1 + self.global_block.block.padding + 1
+
+    def forward(
+        self, x: torch.Tensor, context: Optional[MoEContext] = None
+    ) -> torch.Tensor:
+        x = self.local_block(x, context)
         x = self.global_block(x)
         return x
 
@@ -133,6 +310,10 @@ class SME(nn.Module):
         self.norm_2 = LayerNorm(in_ch, data_format="channels_first")
         self.ffn = GatedFFN(in_ch, mlp_ratio=2, kernel_size=3, act_layer=nn.GELU())
 
+    def fold(self):
+        fold_layer_norm(self.norm_1, self.block.to_qv[0])
+        fold_layer_norm(self.norm_2, self.ffn.fn_1[0])
+
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         x = self.block(self.norm_1(x)) + x
         x = self.ffn(self.norm_2(x)) + x
@@ -189,8 +370,15 @@ class RME(nn.Module):
         self.norm_2 = LayerNorm(in_ch, data_format="channels_first")
         self.ffn = GatedFFN(in_ch, mlp_ratio=2, kernel_size=3, act_layer=nn.GELU())
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        x = self.block(self.norm_1(x)) + x
+    def fold(self):
+        # norm_1 is followed by the 3x3 conv_1 of MoEBlock, its zero padding
+        # does not commute with the bias
+        fold_layer_norm(self.norm_2, self.ffn.fn_1[0])
+
+    def forward(
+        self, x: torch.Tensor, context: Optional[MoEContext] = None
+    ) -> torch.Tensor:
+        x = self.block(self.norm_1(x), context) + x
         x = self.ffn(self.norm_2(x)) + x
         return x
 
@@ -250,6 +438,19 @@ class MoEBlock(nn.Module):
 
         self.proj = nn.Conv2d(in_ch, in_ch, kernel_size=1, padding=0)
 
+    @torch.no_grad()
+    def fold(self):
+        if self.use_shuffle:
+            # The shuffle is a fixed permutation of the output channels of conv_1
+            conv = self.conv_1[2]
+            order = torch.arange(conv.out_channels, device=conv.weight.device)
+            order = channel_shuffle(order.view(1, -1, 1, 1), groups=2).flatten()
+            conv.weight.copy_(conv.weight[order])
+            conv.bias.copy_(conv.bias[order])
+            self.use_shuffle = False
+        if isinstance(self.conv_2[0], StripedConv2d):
+            self.conv_2[0] = self.conv_2[0].fuse()
+
     def calibrate(self, x: torch.Tensor) -> torch.Tensor:
         b, c, h, w = x.shape
         res = x
@@ -260,7 +461,7 @@ class MoEBlock(nn.Module):
         x = F.interpolate(x, size=(h, w), mode="bilinear", align_corners=False)
         return res + x
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def split(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
         x = self.conv_1(x)
 
         if self.use_shuffle:
@@ -268,9 +469,19 @@ class MoEBlock(nn.Module):
         x, k = torch.chunk(x, chunks=2, dim=1)
 
         x = self.conv_2(x)
-        k = self.calibrate(k)
+        return x, k
+
+    def forward(
+        self, x: torch.Tensor, context: Optional[MoEContext] = None
+    ) -> torch.Tensor:
+        x, k = self.split(x)
 
-        x = self.moe_layer(x, k)
+        if context is None:
+            k = self.calibrate(k)
+            x = self.moe_layer(x, k)
+        else:
+            k = k + context.calibration
+            x = self.moe_layer(x, k, context.routing)
         x = self.proj(x)
         return x
 
@@ -282,22 +493,104 @@ class MoELayer(nn.Module):
         self.experts = nn.ModuleList(experts)
         self.gate = gate
         self.num_expert = num_expert
+        self.stacked = False
+
+    @torch.no_grad()
+    def stack_experts(self):
+        """Stack the expert weights into zero padded tensors, so that eval mode
+        selects experts by index on device instead of branching in Python.
+        Must be called again after the expert weights change.
+        """
+        max_dim = max(expert.conv_1.out_channels for expert in self.experts)
+
+        def pad(t: torch.Tensor, dim: int) -> torch.Tensor:
+            shape = list(t.shape)
+            shape[dim] = max_dim - shape[dim]
+            return torch.cat([t, t.new_zeros(shape)], dim=dim)
+
+        w_1, b_1, w_2, b_2, w_3, b_3 = [], [], [], [], [], []
+        for expert in self.experts:
+            w_1.append(pad(expert.conv_1.weight.flatten(1), 0))
+            b_1.append(pad(expert.conv_1.bias, 0))
+            w_2.append(pad(expert.conv_2.weight.flatten(1), 0))
+            b_2.append(pad(expert.conv_2.bias, 0))
+            w_3.append(pad(expert.conv_3.weight.flatten(1), 1))
+            b_3.append(expert.conv_3.bias)
+
+        # (num_experts, max_dim, in_ch), (num_experts, in_ch, max_dim)
+        self.register_buffer("w_1", torch.stack(w_1), persistent=False)
+        self.register_buffer("b_1", torch.stack(b_1), persistent=False)
+        self.register_buffer("w_2", torch.stack(w_2), persistent=False)
+        self.register_buffer("b_2", torch.stack(b_2), persistent=False)
+        self.register_buffer("w_3", torch.stack(w_3), persistent=False)
+        self.register_buffer("b_3", torch.stack(b_3), persistent=False)
+        self.stacked = True
+
+    def forward_stacked(
+        self,
+        inputs: torch.Tensor,
+        k: torch.Tensor,
+        topk_weights: torch.Tensor,
+        topk_experts: torch.Tensor,
+    ) -> torch.Tensor:
+        # Pixels are the rows of the matmuls, so channels_last activations
+        # are used as they are, and the residual add gives the output the
+        # memory format of inputs. Padded channels have zero weights and
+        # biases, so they add nothing.
+        batch, channels, height, width = inputs.shape
+        rows = inputs.permute(0, 2, 3, 1).flatten(1, 2)
+        k_rows = k.permute(0, 2, 3, 1).flatten(1, 2)
+        # (batch, topk * max_dim, in_ch) and (batch, 1, topk * max_dim)
+        w_1 = self.w_1[topk_experts].flatten(1, 2)
+        b_1 = self.b_1[topk_experts].flatten(1)[:, None]
+        w_2 = self.w_2[topk_experts].flatten(1, 2)
+        b_2 = self.b_2[topk_experts].flatten(1)[:, None]
+        x = torch.baddbmm(b_1, rows, w_1.transpose(1, 2))
+        x = x * torch.baddbmm(b_2, k_rows, w_2.transpose(1, 2))
+
+        # Fold the routing weights into conv_3 and sum over the selected experts
+        w_3 = self.w_3[topk_experts] * topk_weights[..., None, None]
+        b_3 = (self.b_3[topk_experts] * topk_weights[..., None]).sum(dim=1)
+        x = torch.baddbmm(b_3[:, None], x, w_3.transpose(2, 3).flatten(1, 2))
+        x = x.view(batch, height, width, channels).permute(0, 3, 1, 2)
+        return inputs + x
+
+    def route(self, logits: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        weights = F.softmax(logits, dim=1, dtype=torch.float).to(logits.dtype)
+        return torch.topk(weights, self.num_expert)
+
+    def forward(
+        self,
+        inputs: torch.Tensor,
+        k: torch.Tensor,
+        routing: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+    ):
+        if routing is None:
+            routing = self.route(self.gate(inputs))
+        topk_weights, topk_experts = routing
+        if self.stacked and not self.training:
+            return self.forward_stacked(inputs, k, topk_weights, topk_experts)
 
-    def forward(self, inputs: torch.Tensor, k: torch.Tensor):
-        out = self.gate(inputs)
-        weights = F.softmax(out, dim=1, dtype=torch.float).to(inputs.dtype)
-        topk_weights, topk_experts = torch.topk(weights, self.num_expert)
         out = inputs.clone()
 
         if self.training:
-            exp_weights = torch.zeros_like(weights)
-            exp_weights.scatter_(1, topk_experts, weights.gather(1, topk_experts))
+            exp_weights = topk_weights.new_zeros(inputs.shape[0], len(self.experts))
+            exp_weights.scatter_(1, topk_experts, topk_weights)
             for i, expert in enumerate(self.experts):
                 out += expert(inputs, k) * exp_weights[:, i : i + 1, None, None]
         else:
-            selected_experts = [self.experts[i] for i in topk_experts.squeeze(dim=0)]
-            for i, expert in enumerate(selected_experts):
-                out += expert(inputs, k) * topk_weights[:, i : i + 1, None, None]
+            # Group samples by their selected experts, so each expert runs at
+            # most once per batch and every sample gets its own routing.
+            for i, expert in enumerate(self.experts):
+                batch_idx, slot_idx = torch.nonzero(topk_experts == i, as_tuple=True)
+                if batch_idx.numel() == 0:
+                    continue
+                weight = topk_weights[batch_idx, slot_idx][:, None, None, None]
+                if batch_idx.numel() == inputs.shape[0]:
+                    out += expert(inputs, k) * weight
+                else:
+                    expert_out = expert(inputs[batch_idx], k[batch_idx]) * weight
+                    out.index_add_(0, batch_idx, expert_out)
 
         return out
 
@@ -369,16 +662,152 @@ class StripedConv2d(nn.Module):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         return self.conv(x)
 
+    @torch.no_grad()
+    def fuse(self) -> "FusedStripedConv2d":
+        """The equivalent single 3x3 conv of a depthwise StripedConv2d"""
+        horizontal, vertical = self.conv
+        if self.kernel_size != 3 or horizontal.groups != self.in_ch:
+            raise ValueError("Only depthwise StripedConv2d of kernel_size 3 fuse")
+        conv = FusedStripedConv2d(self.in_ch).to(horizontal.weight)
+        # (in_ch, 1, 3, 1) x (in_ch, 1, 1, 3), the kernel is rank one
+        conv.weight.copy_(vertical.weight * horizontal.weight)
+        taps = vertical.weight.view(self.in_ch, 3) * horizontal.bias[:, None]
+        conv.bias.copy_(vertical.bias + taps.sum(dim=1))
+        conv.row_border.copy_(taps[:, [0, 2]])
+        return conv
+
+
+class FusedStripedConv2d(nn.Conv2d):
+    """Depthwise StripedConv2d of kernel_size 3 as a single 3x3 conv.
+
+    The bias of the horizontal conv goes through the vertical one, except for
+    the taps that read the zero padding of the vertical conv. row_border holds
+    the contribution of the top and bottom taps per channel, it is taken off
+    the first and last rows.
+    """
+
+    def __init__(self, in_ch: int):
+        super().__init__(in_ch, in_ch, kernel_size=3, padding=1, groups=in_ch)
+        self.register_buffer("row_border", torch.zeros(in_ch, 2), persistent=False)
 
-def channel_shuffle(x, groups=2):
-    bat_size, channels, w, h = x.shape
-    group_c = channels // groups
-    x = x.view(bat_size, groups, group_c, w, h)
-    x = torch.transpose(x, 1, 2).contiguous()
-    x = x.view(bat_size, -1, w, h)
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = super().forward(x)
+        x[:, :, 0, :] -= self.row_border[:, 0, None]
+        x[:, :, -1, :] -= self.row_border[:, 1, None]
+        return x
+
+
+def _iter_tile_batches(x: torch.Tensor, tile_size: int, tile_pad: int, batch_size: int):
+    height, width = x.shape[2:]
+    window_size = (
+        min(tile_size + 2 * tile_pad, height),
+        min(tile_size + 2 * tile_pad, width),
+    )
+    tiles = tile_windows(height, width, tile_size, tile_pad)
+    for i in range(0, len(tiles), batch_size):
+        batch_tiles = tiles[i : i + batch_size]
+        yield batch_tiles, torch.cat(
+            [_window(x, tile, window_size) for tile in batch_tiles]
+        )
+
+
+def _window(x: torch.Tensor, tile, window_size) -> torch.Tensor:
+    window_y, window_x = tile[4:]
+    return x[
+        :, :, window_y : window_y + window_size[0], window_x : window_x + window_size[1]
+    ]
+
+
+def _crop_core(x: torch.Tensor, tile, scale: int = 1) -> torch.Tensor:
+    """Crop the tile itself out of the output of its padded window"""
+    y_start, y_end, x_start, x_end, window_y, window_x = tile
+    top = (y_start - window_y) * scale
+    left = (x_start - window_x) * scale
+    return x[
+        :,
+        :,
+        top : top + (y_end - y_start) * scale,
+        left : left + (x_end - x_start) * scale,
+    ]
+
+
+def interpolate_region(
+    x: torch.Tensor, size: Tuple[int, int], region: Tuple[int, int, int, int]
+) -> torch.Tensor:
+    """The (top, left, height, width) region of
+    F.interpolate(x, size, mode="bilinear", align_corners=False), computed
+    without upsampling the whole map.
+    """
+    top, left, height, width = region
+
+    def source_index(in_size: int, out_size: int, start: int, length: int):
+        scale = in_size / out_size
+        dst = torch.arange(start, start + length, device=x.device, dtype=torch.float)
+        src = ((dst + 0.5) * scale - 0.5).clamp_(min=0)
+        index_0 = src.long().clamp_(max=in_size - 1)
+        index_1 = (index_0 + 1).clamp_(max=in_size - 1)
+        lambda_1 = (src - index_0).to(x.dtype)
+        return index_0, index_1, lambda_1
+
+    row_0, row_1, lambda_y = source_index(x.shape[2], size[0], top, height)
+    col_0, col_1, lambda_x = source_index(x.shape[3], size[1], left, width)
+    lambda_y = lambda_y[:, None]
+    x = x[:, :, row_0] * (1 - lambda_y) + x[:, :, row_1] * lambda_y
+    x = x[..., col_0] * (1 - lambda_x) + x[..., col_1] * lambda_x
     return x
 
 
+class MeanFoldedConv2d(nn.Conv2d):
+    """3x3 conv with padding 1 whose bias has a constant input shift folded in.
+
+    Inside the image the folded bias is exact. Taps that read the zero padding
+    would have seen the shift in the original model, so border holds their
+    contribution per output channel and tap, and it is added back on the
+    border rows and columns.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.register_buffer(
+            "border", torch.zeros(self.out_channels, 3, 3), persistent=False
+        )
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = super().forward(x)
+        border = self.border
+        rows = border.sum(dim=2)[..., None]
+        cols = border.sum(dim=1)[..., None]
+        x[:, :, 0, :] += rows[:, 0]
+        x[:, :, -1, :] += rows[:, 2]
+        x[:, :, :, 0] += cols[:, 0]
+        x[:, :, :, -1] += cols[:, 2]
+        # Corner taps were added twice
+        x[:, :, 0, 0] -= border[:, 0, 0]
+        x[:, :, 0, -1] -= border[:, 0, 2]
+        x[:, :, -1, 0] -= border[:, 2, 0]
+        x[:, :, -1, -1] -= border[:, 2, 2]
+        return x
+
+
+@torch.no_grad()
+def fold_layer_norm(norm: "LayerNorm", conv: nn.Conv2d):
+    """Fold the affine of a channels_first LayerNorm into the 1x1 conv after it"""
+    if not norm.affine:
+        return
+    conv.bias.add_(conv.weight.flatten(1) @ norm.bias)
+    conv.weight.mul_(norm.weight[None, :, None, None])
+    norm.weight.fill_(1)
+    norm.bias.zero_()
+    norm.affine = False
+
+
+def channel_shuffle(x, groups=2):
+    # Copied once into a tensor of the memory format of x
+    out = torch.empty_like(x)
+    out.unflatten(1, (-1, groups)).copy_(x.unflatten(1, (groups, -1)).transpose(1, 2))
+    return out
+
+
 class GatedFFN(nn.Module):
     def __init__(
         self,
@@ -435,19 +864,23 @@ class LayerNorm(nn.Module):
         self.weight = nn.Parameter(torch.ones(normalized_shape))
         self.bias = nn.Parameter(torch.zeros(normalized_shape))
         self.eps = eps
+        # Turned off once the affine is folded into the next layer
+        self.affine = True
         self.data_format = data_format
         if self.data_format not in ["channels_last", "channels_first"]:
             raise NotImplementedError
         self.normalized_shape = (normalized_shape,)
 
     def forward(self, x):
+        weight, bias = (self.weight, self.bias) if self.affine else (None, None)
         if self.data_format == "channels_last":
-            return F.layer_norm(
-                x, self.normalized_shape, self.weight, self.bias, self.eps
-            )
+            return F.layer_norm(x, self.normalized_shape, weight, bias, self.eps)
         elif self.data_format == "channels_first":
-            u = x.mean(1, keepdim=True)
-            s = (x - u).pow(2).mean(1, keepdim=True)
-            x = (x - u) / torch.sqrt(s + self.eps)
-            x = self.weight[:, None, None] * x + self.bias[:, None, None]
-            return x
+            # A single fused pass on a channels last view instead of separate
+            # mean, variance and affine passes. The output has the memory
+            # format of x, channels_last inputs are not copied at all.
+            channels_last = x.is_contiguous(memory_format=torch.channels_last)
+            x = F.layer_norm(
+                x.permute(0, 2, 3, 1), self.normalized_shape, weight, bias, self.eps
+            ).permute(0, 3, 1, 2)
+            return x if channels_last else x.contiguous()
@@ -0,0 +1,142 @@
+"""ONNX Runtime inference without torch.
+
+The ONNX models are exported once with torch, e.g. when building an image:
+
+    python -m seemore.ort seemore_b_x4 seemore_t_x4
+
+OrtUpscaler then only needs numpy, OpenCV and onnxruntime.
+"""
+
+import argparse
+import hashlib
+import os
+from typing import List, Optional, Sequence
+
+import cv2
+import numpy as np
+
+from seemore.cfgs import seemore_model_cfgs
+from seemore.download import get_hub_dir
+from seemore.tiling import tile_windows
+
+# Padding of the tiles, the gradient based choice of SeemoReUpscaler needs torch
+DEFAULT_ORT_TILE_PAD = 32
+
+
+def bundle_suffix(bundle: Optional[str]) -> str:
+    """Artifact name suffix identifying the weight bundle a model came from"""
+    if bundle is None:
+        return ""
+    st = os.stat(bundle)
+    key = f"{os.path.realpath(bundle)}:{st.st_size}:{st.st_mtime_ns}"
+    return "-" + hashlib.sha1(key.encode()).hexdigest()[:12]
+
+
+def onnx_artifact_path(model_name: str, bundle: Optional[str] = None) -> str:
+    """Path of the ONNX export of a model, in the torch hub dir"""
+    name = model_name + bundle_suffix(bundle) + ".onnx"
+    return os.path.join(get_hub_dir(), "seemore", name)
+
+
+def create_session(path: str, providers: Sequence[str] = ("CPUExecutionProvider",)):
+    import onnxruntime
+
+    return onnxruntime.InferenceSession(path, providers=list(providers))
+
+
+class OrtUpscaler:
+    """SeemoReUpscaler on an exported ONNX model, without torch.
+
+    Input and output are uint8 BGR, BGRA or gray images like SeemoReUpscaler.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        onnx_path: Optional[str] = None,
+        providers: Sequence[str] = ("CPUExecutionProvider",),
+    ):
+        if model_name not in seemore_model_cfgs:
+            raise ValueError(
+                f"Model {model_name} not found, available models: {list(seemore_model_cfgs.keys())}"
+            )
+        onnx_path = onnx_path or onnx_artifact_path(model_name)
+        if not os.path.exists(onnx_path):
+            raise FileNotFoundError(
+                f"{onnx_path} not found, export it with `python -m seemore.ort {model_name}`"
+            )
+        self.model_name = model_name
+        self.scale = seemore_model_cfgs[model_name]["scale"]
+        self.onnx_path = onnx_path
+        self.session = create_session(onnx_path, providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def run(self, x: np.ndarray) -> np.ndarray:
+        """(N, 3, H, W) float32 BGR in [0, 255] to (N, 3, H * scale, W * scale)"""
+        return self.session.run(None, {self.input_name: x})[0]
+
+    def __call__(
+        self,
+        np_img: np.ndarray,
+        tile_size: int = 0,
+        tile_pad: int = DEFAULT_ORT_TILE_PAD,
+    ) -> np.ndarray:
+        height, width = np_img.shape[:2]
+        alpha = None
+        gray = np_img.ndim == 2 or np_img.shape[2] == 1
+        if gray:
+            np_img = cv2.cvtColor(np_img.reshape(height, width), cv2.COLOR_GRAY2BGR)
+        elif np_img.shape[2] == 4:
+            alpha = np_img[:, :, 3]
+            np_img = np_img[:, :, 0:3]
+
+        x = np_img.transpose(2, 0, 1)[None].astype(np.float32)
+        scale = self.scale
+        output = np.empty((3, height * scale, width * scale), dtype=np.float32)
+        if tile_size <= 0:
+            output[:] = self.run(x)[0]
+        else:
+            window_h = min(tile_size + 2 * tile_pad, height)
+            window_w = min(tile_size + 2 * tile_pad, width)
+            for y_start, y_end, x_start, x_end, wy, wx in tile_windows(
+                height, width, tile_size, tile_pad
+            ):
+                tile = self.run(x[:, :, wy : wy + window_h, wx : wx + window_w])[0]
+                valid_y = (y_start - wy) * scale
+                valid_x = (x_start - wx) * scale
+                output[
+                    :, y_start * scale : y_end * scale, x_start * scale : x_end * scale
+                ] = tile[
+                    :,
+                    valid_y : valid_y + (y_end - y_start) * scale,
+                    valid_x : valid_x + (x_end - x_start) * scale,
+                ]
+
+        restored_img = np.empty(
+            (height * scale, width * scale, 3 if alpha is None else 4), dtype=np.uint8
+        )
+        np.clip(np.rint(output), 0, 255, out=output)
+        restored_img[:, :, :3] = output.transpose(1, 2, 0)
+        if gray:
+            restored_img = cv2.cvtColor(restored_img, cv2.COLOR_BGR2GRAY)
+        elif alpha is not None:
+            restored_img[:, :, 3] = cv2.resize(
+                alpha, (width * scale, height * scale), interpolation=cv2.INTER_LINEAR
+            )
+        return restored_img
+
+
+def main(args: Optional[List[str]] = None):
+    from seemore.core import export_onnx
+
+    parser = argparse.ArgumentParser(description="Export SeemoRe models to ONNX")
+    parser.add_argument("models", nargs="*", help="default: all models")
+    parser.add_argument("--bundle", help="load the weights from a weight bundle")
+    args = parser.parse_args(args)
+
+    for model_name in args.models or list(seemore_model_cfgs):
+        print(export_onnx(model_name, bundle=args.bundle))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+"""Tile layout shared by the torch and ONNX Runtime paths, free of torch"""
+
+from typing import List, Tuple
+
+
+def tile_windows(
+    height: int, width: int, tile_size: int, tile_pad: int
+) -> List[Tuple[int, int, int, int, int, int]]:
+    """Split an image into tiles with padded windows of the same size.
+
+    Returns (y_start, y_end, x_start, x_end, window_y, window_x) per tile. The
+    windows of edge tiles are shifted inwards instead of being cut off.
+    """
+    window_h = min(tile_size + 2 * tile_pad, height)
+    window_w = min(tile_size + 2 * tile_pad, width)
+    tiles = []
+    for y_start in range(0, height, tile_size):
+        for x_start in range(0, width, tile_size):
+            y_end = min(y_start + tile_size, height)
+            x_end = min(x_start + tile_size, width)
+            window_y = min(max(y_start - tile_pad, 0), height - window_h)
+            window_x = min(max(x_start - tile_pad, 0), width - window_w)
+            tiles.append((y_start, y_end, x_start, x_end, window_y, window_x))
+    return tiles
@@ -4,3 +4,72 @@ import sys
 # 将项目 src 目录添加到 Python 路径
 project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(os.path.join(project_root, "src"))
+
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    """Serves files with Range support, records requests and bytes sent.
+
+    Once server.max_bytes bytes have been sent, responses are cut short to
+    simulate a dropped connection.
+    """
+
+    def do_GET(self):
+        server = self.server
+        range_header = self.headers.get("Range")
+        with server.lock:
+            server.requests.append((self.path, range_header))
+        path = server.root / self.path.lstrip("/")
+        if not path.is_file():
+            self.send_error(404)
+            return
+
+        data = path.read_bytes()
+        start, end = 0, len(data)
+        if range_header and server.accept_ranges:
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header)
+            start = int(match[1])
+            end = min(int(match[2]) + 1, len(data)) if match[2] else len(data)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        if server.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+
+        body = data[start:end]
+        with server.lock:
+            if server.max_bytes is not None:
+                body = body[: max(server.max_bytes - server.bytes_sent, 0)]
+            server.bytes_sent += len(body)
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server(tmp_path):
+    """本地 HTTP 服务, 提供 tmp_path / "www" 下的文件并记录请求"""
+    root = tmp_path / "www"
+    root.mkdir()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    server.root = root
+    server.requests = []
+    server.bytes_sent = 0
+    server.max_bytes = None
+    server.accept_ranges = True
+    server.lock = threading.Lock()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
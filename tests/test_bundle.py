@@ -0,0 +1,100 @@
+"""测试多模型权重包"""
+
+import os
+
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from seemore import SeemoReUpscaler
+from seemore.bundle import WeightBundle, open_bundle, write_bundle
+from seemore.cfgs import network_cfg
+from seemore.module import SeemoRe
+
+
+def random_state_dicts():
+    state_dicts = {}
+    for seed, model_name in enumerate(["seemore_t_x2", "seemore_b_x3"]):
+        torch.manual_seed(seed)
+        state_dicts[model_name] = SeemoRe(**network_cfg(model_name)).state_dict()
+    return state_dicts
+
+
+@pytest.mark.parametrize(
+    "storage_dtype", [torch.float32, torch.float16, torch.bfloat16]
+)
+def test_bundle_roundtrip(tmp_path, storage_dtype):
+    """权重包中的每个模型都能按名称读出, 低精度存储在加载时转回 float32"""
+    state_dicts = random_state_dicts()
+    path = str(tmp_path / "seemore.bundle")
+    write_bundle(path, state_dicts, storage_dtype)
+
+    bundle = WeightBundle(path)
+    assert bundle.model_names() == list(state_dicts)
+    assert bundle.storage_dtype == storage_dtype
+    for model_name, expected in state_dicts.items():
+        state_dict = bundle.state_dict(model_name)
+        assert list(state_dict) == list(expected)
+        for key, tensor in state_dict.items():
+            assert tensor.dtype == torch.float32
+            torch.testing.assert_close(
+                tensor, expected[key].to(storage_dtype).float(), rtol=0, atol=0
+            )
+        SeemoRe(**network_cfg(model_name)).load_state_dict(state_dict, strict=True)
+
+
+def test_bundle_copy_on_write(tmp_path):
+    """原地修改加载的权重不影响文件和之后的加载"""
+    state_dicts = random_state_dicts()
+    path = str(tmp_path / "seemore.bundle")
+    write_bundle(path, state_dicts)
+
+    bundle = open_bundle(path)
+    key = "conv_1.weight"
+    bundle.state_dict("seemore_t_x2")[key].zero_()
+    torch.testing.assert_close(
+        bundle.state_dict("seemore_t_x2")[key], state_dicts["seemore_t_x2"][key]
+    )
+    assert WeightBundle(path).state_dict("seemore_t_x2")[key].abs().sum() > 0
+
+    with pytest.raises(KeyError):
+        bundle.state_dict("seemore_b_x4")
+
+
+def test_open_bundle_rewritten(tmp_path):
+    """重写权重包后 open_bundle 读取新的索引"""
+    state_dicts = random_state_dicts()
+    path = str(tmp_path / "seemore.bundle")
+    write_bundle(path, {"seemore_t_x2": state_dicts["seemore_t_x2"]})
+    assert open_bundle(path).model_names() == ["seemore_t_x2"]
+    assert open_bundle(path) is open_bundle(path)
+
+    write_bundle(path, state_dicts, torch.float16)
+    bundle = open_bundle(path)
+    assert bundle.model_names() == list(state_dicts)
+    assert bundle.storage_dtype == torch.float16
+
+
+def test_bundle_invalid_file(tmp_path):
+    path = tmp_path / "model.pth"
+    path.write_bytes(b"not a bundle")
+    with pytest.raises(ValueError):
+        WeightBundle(str(path))
+
+
+def test_upscaler_from_bundle(tmp_path):
+    """从权重包加载的模型与从 checkpoint 加载的结果一致"""
+    from seemore.cfgs import seemore_model_cfgs
+    from seemore.core import load_state_dict
+    from seemore.download import get_cache_path_by_url
+
+    reference = SeemoReUpscaler("seemore_t_x2", device="cpu", cache=False)
+    ckpt_path = get_cache_path_by_url(seemore_model_cfgs["seemore_t_x2"]["url"])
+    path = str(tmp_path / "seemore.bundle")
+    write_bundle(path, {"seemore_t_x2": load_state_dict(ckpt_path)})
+
+    upscaler = SeemoReUpscaler("seemore_t_x2", device="cpu", bundle=path)
+    img = cv2.imread(os.path.join(os.path.dirname(__file__), "bunny.jpeg"))[:48, :64]
+    np.testing.assert_array_equal(upscaler(img), reference(img))
+    upscaler.close()
@@ -1,10 +1,19 @@
 """测试模块"""
 
+import inspect
 import os
+import warnings
 import cv2
 import numpy as np
 import pytest
 from seemore import SeemoReUpscaler
+from seemore.core import (
+    MAX_AUTO_TILE_PAD,
+    bucket_size,
+    image_to_tensor,
+    receptive_field,
+    seemore_model_cfgs,
+)
 import torch
 
 test_img_path = os.path.join(os.path.dirname(__file__), "bunny.jpeg")
@@ -62,6 +71,158 @@ def test_tile_inference():
     assert result_tiled.shape == result_full.shape
 
 
+def test_batched_tile_inference():
+    """测试分块批量推理与逐块推理结果一致"""
+    seemore = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    img = cv2.imread(test_img_path)[:150, :200]
+    y = image_to_tensor(img)
+
+    single = seemore.tile_inference(y, tile_size=64, batch_size=1)
+    batched = seemore.tile_inference(y, tile_size=64, batch_size=4)
+    auto = seemore.tile_inference(y, tile_size=64)
+
+    assert batched.shape == (1, 3, 300, 400)
+    torch.testing.assert_close(batched, single, rtol=1e-4, atol=1e-3)
+    torch.testing.assert_close(auto, single, rtol=1e-4, atol=1e-3)
+
+
+def test_global_context_tile_inference():
+    """测试共享全图上下文的分块推理与整图推理一致"""
+    seemore = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    img = cv2.imread(test_img_path)[:150, :200]
+
+    result_tiled = seemore(img, tile_size=48, global_context=True)
+    result_full = seemore(img)
+
+    assert result_tiled.shape == result_full.shape
+    diff = np.abs(result_tiled.astype(np.int16) - result_full.astype(np.int16))
+    assert diff.max() <= 1
+
+
+def test_tile_inference_uint8_output():
+    """测试分块推理直接写入 uint8 输出"""
+    seemore = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    img = cv2.imread(test_img_path)[:100, :120]
+    y = image_to_tensor(img)
+
+    expected = seemore.tile_inference(y, tile_size=48, tile_pad=8)
+    expected = expected[0].permute(1, 2, 0).round().clamp(0, 255).byte()
+    out = np.zeros((200, 240, 4), dtype=np.uint8)
+    seemore.tile_inference(y, tile_size=48, tile_pad=8, out=out)
+
+    np.testing.assert_array_equal(out[:, :, :3], expected.numpy())
+    assert not out[:, :, 3].any()
+
+
+def test_auto_tile_size():
+    """测试根据内存预算自动选择 tile size"""
+    seemore = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    img = cv2.imread(test_img_path)[:150, :200]
+
+    # 预算足够时整图推理
+    assert seemore.auto_tile_size(150, 200, 1 << 40)[0] == 0
+
+    budget = 16 << 20
+    tile_size, tile_memory = seemore.auto_tile_size(150, 200, budget)
+    assert 0 < tile_size < 200
+    assert tile_memory < budget
+
+    result = seemore(img, tile_size="auto", max_memory_bytes=budget)
+    assert result.shape == (300, 400, 3)
+
+    # 预算过小时告警, 并以 0 字节预算逐块推理, 而不是退回默认预算
+    with pytest.warns(RuntimeWarning):
+        assert seemore.auto_tile_size(150, 200, 1 << 19) == (32, 0)
+    budgets = []
+    tile_inference = seemore.tile_inference
+
+    def spy(*args, **kwargs):
+        budgets.append(kwargs["max_memory_bytes"])
+        return tile_inference(*args, **kwargs)
+
+    seemore.tile_inference = spy
+    with pytest.warns(RuntimeWarning):
+        result = seemore(img[:60, :80], tile_size="auto", max_memory_bytes=1 << 16)
+    assert result.shape == (120, 160, 3)
+    assert budgets == [0]
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/meminfo"), reason="Linux only")
+def test_available_memory_bytes():
+    """CPU 可用内存包含可回收的页缓存 (MemAvailable)"""
+    from seemore.core import available_memory_bytes
+
+    with open("/proc/meminfo") as f:
+        meminfo = dict(line.split(":", 1) for line in f)
+    expected = int(meminfo["MemAvailable"].split()[0]) * 1024
+    assert abs(available_memory_bytes("cpu") - expected) < 256 << 20
+
+
+def test_receptive_field():
+    """测试感受野计算"""
+    cfg = seemore_model_cfgs["seemore_b_x4"]
+    # conv_1 + 8 * (MoEBlock 40 + GatedFFN 1 + StripedConvFormer 5 + GatedFFN 1) + 2
+    assert receptive_field(cfg) == 379
+    assert receptive_field(cfg, include_calibrate=False) == 75
+    assert receptive_field(seemore_model_cfgs["seemore_t_x2"]) == 285
+
+
+def test_receptive_field_exact():
+    """感受野与梯度实际可达的范围一致 (Router 权重置零)"""
+    from seemore.cfgs import network_cfg
+    from seemore.module import Router, SeemoRe
+
+    cfg = dict(network_cfg("seemore_b_x4"), num_layers=1)
+    torch.manual_seed(0)
+    model = SeemoRe(**cfg).eval()
+    for module in model.modules():
+        if isinstance(module, Router):
+            torch.nn.init.zeros_(module.body[2].weight)
+    x = torch.rand(1, 3, 224, 224, requires_grad=True)
+    # One whole 16 px calibration cell covers every alignment to the grid
+    start, scale = 96, cfg["scale"]
+    cell = slice(start * scale, (start + 16) * scale)
+    model(x)[:, :, cell, cell].sum().backward()
+    reached = (x.grad.abs().sum((0, 1, 2)) > 0).nonzero().flatten()
+    radius = receptive_field(cfg)
+    assert reached.min() == start - radius
+    assert reached.max() == start + 15 + radius
+
+
+def test_auto_tile_pad():
+    """测试自动选择 tile_pad"""
+    seemore = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    loose = seemore.choose_tile_pad(64, seam_tol=4 / 255)
+    tight = seemore.choose_tile_pad(64, seam_tol=0.25 / 255)
+    assert 0 <= loose.tile_pad <= tight.tile_pad
+    assert loose.seam_error <= 4 / 255
+    assert loose.halo_overhead <= tight.halo_overhead
+
+    # 画布超出最大 tile_pad, 达不到 seam_tol 时给出警告
+    with pytest.warns(RuntimeWarning, match="global_context"):
+        exact = seemore.choose_tile_pad(64, seam_tol=0)
+    assert exact.tile_pad == MAX_AUTO_TILE_PAD
+    assert exact.seam_error > 0
+
+    img = cv2.imread(test_img_path)
+    result = seemore(img[:100, :120], tile_size=48)
+    assert result.shape == (200, 240, 3)
+
+
+def test_seam_error_profile_shared(monkeypatch):
+    """seam 误差曲线按模型只计算一次, 共享模型在 inference_mode 下创建也可用"""
+    import seemore.core
+
+    monkeypatch.setattr(seemore.core, "_seam_error_profiles", {})
+    with torch.inference_mode():
+        first = SeemoReUpscaler("seemore_t_x3", device="cpu", cache=False)
+    img = cv2.imread(test_img_path)[:60, :80]
+    assert first(img, tile_size=32).shape == (180, 240, 3)
+
+    second = SeemoReUpscaler("seemore_t_x3", device="cpu", cache=False)
+    assert second.seam_error_profile() is first.seam_error_profile()
+
+
 def test_custom_scale():
     """测试自定义缩放比例"""
     seemore = SeemoReUpscaler("seemore_b_x4", device="cpu")
@@ -124,3 +285,257 @@ def test_all_models(model_name):
     assert result.shape[1] == w * scale
     assert result.shape[2] == 3  # BGR channels
     assert result.dtype == np.uint8
+
+
+def test_model_cache():
+    """测试多个 SeemoReUpscaler 共享同一份模型"""
+    from seemore.model_cache import model_cache
+
+    first = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    second = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    assert first.model is second.model
+    assert model_cache.refcount(first.cache_key) >= 2
+
+    private = SeemoReUpscaler("seemore_t_x2", device="cpu", cache=False)
+    assert private.model is not first.model
+
+    key = first.cache_key
+    refs = model_cache.refcount(key)
+    second.close()
+    assert model_cache.refcount(key) == refs - 1
+
+    # 驱逐后仍在使用的 upscaler 可以继续工作, 新建的 upscaler 重新加载
+    assert model_cache.evict(key)
+    img = cv2.imread(test_img_path)[:32, :32]
+    assert first(img).shape == (64, 64, 3)
+    third = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    assert third.model is not first.model
+    # 旧 upscaler 关闭时不减少新条目的引用计数
+    first.close()
+    assert model_cache.refcount(key) == 1
+    assert key not in model_cache.evict_unused()
+    third.close()
+
+
+def test_upscaler_manager():
+    """测试按内存预算淘汰最久未使用的模型"""
+    from seemore.manager import UpscalerManager, model_nbytes
+
+    size = model_nbytes(SeemoReUpscaler("seemore_t_x2", device="cpu").model)
+    manager = UpscalerManager(max_bytes=int(size * 1.5), device="cpu")
+
+    first = manager.get("seemore_t_x2")
+    assert manager.get("seemore_t_x2") is first
+    manager.get("seemore_t_x3")
+    assert manager.resident() == ["seemore_t_x3"]
+    manager.get("seemore_t_x2")
+    assert manager.resident() == ["seemore_t_x2"]
+
+    stats = manager.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 3, 2)
+    assert 0 < stats["resident_bytes"] <= manager.max_bytes
+
+    # 被淘汰的 upscaler 在调用方手中仍可使用
+    img = cv2.imread(test_img_path)[:32, :32]
+    assert first(img).shape == (64, 64, 3)
+    manager.clear()
+    assert manager.resident() == []
+
+
+def test_upscaler_manager_loads_outside_lock(monkeypatch):
+    """加载冷模型时不阻塞已驻留模型的 get"""
+    import threading
+    import time
+
+    import seemore.manager
+    from seemore.manager import UpscalerManager
+
+    started = threading.Event()
+    finish = threading.Event()
+
+    class SlowUpscaler:
+        def __init__(self, model_name, *args, **kwargs):
+            if model_name == "cold":
+                started.set()
+                finish.wait(5)
+            self.model = torch.nn.Linear(4, 4)
+            self.cache_key = model_name
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(seemore.manager, "SeemoReUpscaler", SlowUpscaler)
+    manager = UpscalerManager(max_bytes=1 << 20)
+    hot = manager.get("hot")
+    thread = threading.Thread(target=manager.get, args=("cold",))
+    thread.start()
+    started.wait(5)
+    start = time.perf_counter()
+    assert manager.get("hot") is hot
+    assert time.perf_counter() - start < 1
+    finish.set()
+    thread.join()
+    assert manager.resident() == ["hot", "cold"]
+
+
+def test_load_state_dict(tmp_path):
+    """测试 checkpoint 首次加载后转换为可 mmap 的权重文件"""
+    from seemore.core import load_state_dict
+
+    params = {"weight": torch.randn(4, 3), "bias": torch.randn(4)}
+    ckpt_path = str(tmp_path / "model.pth")
+    torch.save({"params": params}, ckpt_path)
+
+    first = load_state_dict(ckpt_path)
+    second = load_state_dict(ckpt_path)
+    for state_dict in (first, second):
+        assert state_dict.keys() == params.keys()
+        for name, tensor in params.items():
+            torch.testing.assert_close(state_dict[name], tensor)
+
+    if "mmap" not in inspect.signature(torch.load).parameters:
+        return
+    assert len(list(tmp_path.glob("model.*.params.pt"))) == 1
+
+    # 更新后的 checkpoint 重新转换, 不被旧的权重文件遮蔽
+    params = {"weight": torch.randn(4, 3), "bias": torch.randn(4)}
+    torch.save({"params": params}, ckpt_path)
+    updated = load_state_dict(ckpt_path)
+    torch.testing.assert_close(updated["weight"], params["weight"])
+    assert len(list(tmp_path.glob("model.*.params.pt"))) == 1
+
+
+def test_load_async():
+    """后台加载与预热, 完成后可直接使用"""
+    future = SeemoReUpscaler.load_async(
+        "seemore_t_x2", device="cpu", cache=False, warmup_sizes=[(32, 32)]
+    )
+    upscaler = future.result(timeout=300)
+    assert future.done()
+    img = cv2.imread(test_img_path)[:32, :32]
+    assert upscaler(img).shape == (64, 64, 3)
+
+    failed = SeemoReUpscaler.load_async("seemore_x_x2")
+    with pytest.raises(ValueError):
+        failed.result(timeout=300)
+
+
+def test_bucket_size():
+    """尺寸桶为 16 的倍数, 填充不超过边长的 1/8"""
+    sizes = range(1, 3000)
+    buckets = {bucket_size(size) for size in sizes}
+    for size in sizes:
+        bucket = bucket_size(size)
+        assert bucket % 16 == 0
+        assert size <= bucket < max(size * 1.125, size + 16)
+    assert len(buckets) < 100
+
+
+def test_shape_buckets():
+    """相同尺寸桶的输入复用同一形状, 输出裁剪回原尺寸"""
+    seemore = SeemoReUpscaler("seemore_t_x2", device="cpu", bucket_shapes=True)
+    reference = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    img = cv2.imread(test_img_path)
+
+    for h, w in [(40, 50), (45, 60), (48, 64), (70, 33)]:
+        result = seemore(img[:h, :w])
+        assert result.shape == (h * 2, w * 2, 3)
+        # 填充只影响右侧和下方边缘附近的像素
+        expected = reference(img[:h, :w])
+        diff = np.abs(result.astype(int) - expected.astype(int))[:-16, :-16]
+        assert diff.max() <= 2
+
+    stats = seemore.bucket_stats()
+    assert (stats["hits"], stats["misses"]) == (2, 2)
+    assert stats["buckets"] == {(48, 64): 3, (80, 48): 1}
+
+
+def test_compile_backend():
+    """compile 后端与 eager 后端结果一致"""
+    img = cv2.imread(test_img_path)[:40, :60]
+    eager = SeemoReUpscaler("seemore_t_x2", device="cpu", bucket_shapes=True)
+    compiled = SeemoReUpscaler("seemore_t_x2", device="cpu", backend="compile")
+    assert compiled.bucket_shapes
+
+    result = compiled(img)
+    assert result.shape == (80, 120, 3)
+    diff = np.abs(result.astype(int) - eager(img).astype(int))
+    assert diff.max() <= 1
+    compiled.close()
+
+
+def test_torchscript_backend(tmp_path, monkeypatch):
+    """torchscript 后端缓存冻结后的程序, 结果与 eager 后端一致"""
+    import seemore.core
+
+    monkeypatch.setattr(seemore.core, "get_hub_dir", lambda: str(tmp_path))
+    img = cv2.imread(test_img_path)[:40, :60]
+    reference = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    expected = reference(img)
+
+    upscaler = SeemoReUpscaler("seemore_t_x2", device="cpu", backend="torchscript")
+    path = seemore.core.script_artifact_path("seemore_t_x2")
+    assert path.startswith(str(tmp_path))
+    assert os.path.exists(path)
+    np.testing.assert_array_equal(upscaler(img), expected)
+    # 任意尺寸与分块推理
+    result = upscaler(cv2.imread(test_img_path)[:70, :50], tile_size=32)
+    assert result.shape == (140, 100, 3)
+    with pytest.raises(ValueError):
+        upscaler(img, tile_size=32, global_context=True)
+    upscaler.close()
+
+    # 已有缓存时不再构建 eager 模型
+    def fail(**kwargs):
+        raise AssertionError("eager model built")
+
+    monkeypatch.setattr(seemore.core, "SeemoRe", fail)
+    cached = SeemoReUpscaler(
+        "seemore_t_x2", device="cpu", backend="torchscript", cache=False
+    )
+    np.testing.assert_array_equal(cached(img), expected)
+
+    from seemore.manager import model_nbytes
+
+    assert model_nbytes(cached.model) > 0.9 * model_nbytes(reference.model)
+
+
+def test_image_to_tensor_channels_last():
+    """HWC 图像直接映射为 channels_last 张量, 数值与默认布局一致"""
+    img = cv2.imread(test_img_path)[:30, :40]
+    for np_img in [img, cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)]:
+        y = image_to_tensor(np_img, memory_format=torch.channels_last)
+        assert y.shape == (1, 3, 30, 40)
+        assert y.is_contiguous(memory_format=torch.channels_last)
+        torch.testing.assert_close(y, image_to_tensor(np_img), rtol=0, atol=0)
+
+
+def test_image_to_tensor_flipped():
+    """翻转 (负步长) 和只读的数组也能转换"""
+    img = cv2.imread(test_img_path)[:30, :40]
+    expected = image_to_tensor(img)
+    torch.testing.assert_close(image_to_tensor(img[::-1]), expected.flip(2))
+    torch.testing.assert_close(image_to_tensor(img[:, ::-1]), expected.flip(3))
+    torch.testing.assert_close(image_to_tensor(img[..., ::-1]), expected.flip(1))
+
+    read_only = np.frombuffer(img.tobytes(), dtype=np.uint8).reshape(img.shape)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        torch.testing.assert_close(image_to_tensor(read_only), expected)
+
+
+def test_channels_last():
+    """channels_last 推理与默认布局结果一致, 包括分块推理"""
+    img = cv2.imread(test_img_path)[:60, :80]
+    reference = SeemoReUpscaler("seemore_t_x2", device="cpu")
+    upscaler = SeemoReUpscaler("seemore_t_x2", device="cpu", channels_last=True)
+    assert upscaler.cache_key != reference.cache_key
+    weight = upscaler.model.conv_2.weight
+    assert weight.is_contiguous(memory_format=torch.channels_last)
+
+    for kwargs in [{}, {"tile_size": 32}, {"tile_size": 32, "global_context": True}]:
+        diff = np.abs(upscaler(img, **kwargs).astype(int) - reference(img, **kwargs))
+        assert diff.max() <= 1
+    y = image_to_tensor(img, memory_format=torch.channels_last)
+    output = upscaler.tile_inference(y, tile_size=32, tile_pad=8)
+    assert output.is_contiguous(memory_format=torch.channels_last)
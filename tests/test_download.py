@@ -0,0 +1,196 @@
+"""测试模型下载"""
+
+import hashlib
+import os
+import re
+import threading
+
+import pytest
+
+import seemore.download
+from seemore.cfgs import seemore_model_cfgs
+from seemore.download import (
+    atomic_write,
+    download_model,
+    get_cache_path_by_url,
+    verify_file,
+)
+
+
+@pytest.fixture
+def hub_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("TORCH_HOME", str(tmp_path / "torch"))
+    return tmp_path / "torch" / "hub"
+
+
+def num_downloads(server) -> int:
+    """每次下载先用 1 字节的 range 请求探测文件大小"""
+    return sum(1 for _, range_header in server.requests if range_header == "bytes=0-0")
+
+
+def test_concurrent_download(http_server, hub_dir):
+    """多个并发调用只下载一次, 且不会读到未写完的文件"""
+    content = os.urandom(3 << 20)
+    (http_server.root / "model.pth").write_bytes(content)
+    url = f"{http_server.url}/model.pth"
+    md5 = hashlib.md5(content).hexdigest()
+
+    results, errors = [], []
+
+    def worker():
+        try:
+            path = download_model(url, md5)
+            with open(path, "rb") as f:
+                results.append(f.read() == content)
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert results == [True] * 8
+    assert num_downloads(http_server) == 1
+    assert http_server.bytes_sent == len(content) + 1
+    # 3 个分块并行下载
+    assert len(http_server.requests) == 4
+    cached_file = get_cache_path_by_url(url)
+    assert cached_file.startswith(str(hub_dir))
+    assert sorted(os.listdir(os.path.dirname(cached_file))) == [
+        "model.pth",
+        "model.pth.lock",
+        "model.pth.sha256",
+    ]
+
+
+def test_download_md5_mismatch(http_server, hub_dir):
+    """校验失败时不会留下缓存文件"""
+    (http_server.root / "model.pth").write_bytes(b"corrupted")
+    url = f"{http_server.url}/model.pth"
+
+    with pytest.raises(ValueError):
+        download_model(url, "0" * 32)
+    cached_file = get_cache_path_by_url(url)
+    assert sorted(os.listdir(os.path.dirname(cached_file))) == ["model.pth.lock"]
+
+
+def test_verify_file_sidecar(tmp_path, monkeypatch):
+    """校验结果写入 sidecar, 文件未变化时不再重新计算 sha256"""
+    path = tmp_path / "model.pth"
+    path.write_bytes(b"weights")
+    sha256 = hashlib.sha256(b"weights").hexdigest()
+
+    assert verify_file(str(path), sha256)
+    assert (tmp_path / "model.pth.sha256").exists()
+
+    def fail(filename):
+        raise AssertionError("file hashed again")
+
+    with monkeypatch.context() as m:
+        m.setattr(seemore.download, "sha256sum", fail)
+        assert verify_file(str(path), sha256)
+        assert not verify_file(str(path), "0" * 64)
+
+    # 大小或修改时间变化后重新计算
+    path.write_bytes(b"truncated")
+    assert not verify_file(str(path), sha256)
+    # 未给出 sha256 时与首次校验记录的比较
+    assert not verify_file(str(path))
+
+
+@pytest.mark.parametrize("expected", [True, False])
+def test_download_replaces_corrupted_cache(http_server, hub_dir, expected):
+    """缓存文件损坏后会重新下载, 未给出 sha256 时以首次下载记录的为准"""
+    content = os.urandom(1 << 16)
+    (http_server.root / "model.pth").write_bytes(content)
+    url = f"{http_server.url}/model.pth"
+    sha256 = hashlib.sha256(content).hexdigest() if expected else None
+
+    cached_file = download_model(url, sha256=sha256)
+    assert download_model(url, sha256=sha256) == cached_file
+    assert num_downloads(http_server) == 1
+
+    with open(cached_file, "r+b") as f:
+        f.truncate(100)
+    assert download_model(url, sha256=sha256) == cached_file
+    assert num_downloads(http_server) == 2
+    with open(cached_file, "rb") as f:
+        assert f.read() == content
+
+
+def test_model_cfgs_sha256():
+    """每个模型都有 sha256 字段, 值为 None (首次校验时记录) 或 64 位十六进制"""
+    for model_name, cfg in seemore_model_cfgs.items():
+        assert "sha256" in cfg, model_name
+        digest = cfg["sha256"]
+        assert digest is None or re.fullmatch("[0-9a-f]{64}", digest), model_name
+
+
+def test_resume_download(http_server, hub_dir):
+    """中断的下载从已完成的分块继续"""
+    content = os.urandom(4 << 20)
+    (http_server.root / "model.pth").write_bytes(content)
+    url = f"{http_server.url}/model.pth"
+    sha256 = hashlib.sha256(content).hexdigest()
+
+    http_server.max_bytes = (3 << 20) // 2
+    with pytest.raises(OSError):
+        download_model(url, sha256=sha256, num_workers=1)
+    cached_file = get_cache_path_by_url(url)
+    assert not os.path.exists(cached_file)
+    assert os.path.exists(cached_file + ".partial")
+
+    http_server.max_bytes = None
+    http_server.bytes_sent = 0
+    assert download_model(url, sha256=sha256) == cached_file
+    # 只重新下载未完成的 3 个分块
+    assert http_server.bytes_sent == 1 + (3 << 20)
+    with open(cached_file, "rb") as f:
+        assert f.read() == content
+    assert not os.path.exists(cached_file + ".partial")
+    assert not os.path.exists(cached_file + ".partial.json")
+
+
+def test_download_mirrors(http_server, hub_dir):
+    """主地址不可用时使用镜像地址"""
+    content = os.urandom(1 << 16)
+    (http_server.root / "model.pth").write_bytes(content)
+    sha256 = hashlib.sha256(content).hexdigest()
+    url = f"{http_server.url}/missing/model.pth"
+    mirrors = [f"{http_server.url}/other/model.pth", f"{http_server.url}/model.pth"]
+
+    cached_file = download_model(url, sha256=sha256, mirrors=mirrors)
+    assert os.path.basename(cached_file) == "model.pth"
+    with open(cached_file, "rb") as f:
+        assert f.read() == content
+
+
+def test_download_without_ranges(http_server, hub_dir):
+    """服务端不支持 range 请求时整体下载"""
+    content = os.urandom(3 << 20)
+    (http_server.root / "model.pth").write_bytes(content)
+    url = f"{http_server.url}/model.pth"
+    http_server.accept_ranges = False
+
+    cached_file = download_model(url, sha256=hashlib.sha256(content).hexdigest())
+    assert http_server.requests == [("/model.pth", "bytes=0-0")]
+    with open(cached_file, "rb") as f:
+        assert f.read() == content
+
+
+def test_atomic_write(tmp_path):
+    """atomic_write 成功时替换目标文件, 失败时保留原文件且不留临时文件"""
+    path = str(tmp_path / "file")
+    with atomic_write(path) as tmp, open(tmp, "w") as f:
+        f.write("new")
+    assert open(path).read() == "new"
+
+    with pytest.raises(RuntimeError):
+        with atomic_write(path) as tmp, open(tmp, "w") as f:
+            f.write("partial")
+            raise RuntimeError
+    assert open(path).read() == "new"
+    assert os.listdir(tmp_path) == ["file"]
@@ -0,0 +1,39 @@
+"""测试 import seemore 不会加载 torch 与 cv2"""
+
+import os
+import subprocess
+import sys
+
+src_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+
+
+def run_python(code: str) -> str:
+    env = dict(os.environ, PYTHONPATH=src_dir)
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+
+
+def test_import_is_lightweight():
+    """列出模型与查看版本时不应导入重量级依赖"""
+    output = run_python(
+        "import sys, seemore; "
+        "assert len(seemore.seemore_model_cfgs) == 6; "
+        "assert seemore.__version__; "
+        "print(sorted(m for m in ('torch', 'cv2', 'numpy') if m in sys.modules))"
+    )
+    assert output == "[]"
+
+
+def test_lazy_upscaler_import():
+    """访问 SeemoReUpscaler 时才导入 torch"""
+    output = run_python(
+        "import sys, seemore; "
+        "from seemore import SeemoReUpscaler; "
+        "print('torch' in sys.modules, SeemoReUpscaler.__module__)"
+    )
+    assert output == "True seemore.core"
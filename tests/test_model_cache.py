@@ -0,0 +1,87 @@
+"""ModelCache 测试 (不加载真实模型)"""
+
+import threading
+import time
+
+import pytest
+
+from seemore.model_cache import ModelCache
+
+
+def test_stale_release_after_evict():
+    """驱逐后重新加载, 旧句柄的 release 不影响新条目"""
+    cache = ModelCache()
+    first = cache.acquire("key", object)
+    assert cache.evict("key")
+    second = cache.acquire("key", object)
+    assert second.model is not first.model
+    assert cache.refcount("key") == 1
+
+    cache.release(first)
+    cache.release(first)
+    assert cache.refcount("key") == 1
+    assert cache.evict_unused() == []
+    assert "key" in cache
+
+    cache.release(second)
+    assert cache.evict_unused() == ["key"]
+
+
+def test_load_does_not_block_other_keys():
+    """加载慢模型时, 其他已缓存模型的 acquire 不被阻塞"""
+    cache = ModelCache()
+    hot = cache.acquire("hot", object)
+    started = threading.Event()
+    finish = threading.Event()
+
+    def slow_loader():
+        started.set()
+        finish.wait(5)
+        return object()
+
+    thread = threading.Thread(target=cache.acquire, args=("cold", slow_loader))
+    thread.start()
+    started.wait(5)
+    start = time.perf_counter()
+    assert cache.acquire("hot", object).model is hot.model
+    assert time.perf_counter() - start < 1
+    finish.set()
+    thread.join()
+    assert cache.refcount("cold") == 1
+
+
+def test_concurrent_acquire_loads_once():
+    """同一个 key 的并发 acquire 只加载一次"""
+    cache = ModelCache()
+    calls = []
+
+    def loader():
+        calls.append(1)
+        time.sleep(0.2)
+        return object()
+
+    handles = []
+    threads = [
+        threading.Thread(target=lambda: handles.append(cache.acquire("key", loader)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len({id(handle.model) for handle in handles}) == 1
+    assert cache.refcount("key") == 4
+
+
+def test_failed_load_is_not_cached():
+    """加载失败时条目被清理, 下一次 acquire 重新加载"""
+    cache = ModelCache()
+
+    def fail():
+        raise RuntimeError("download failed")
+
+    with pytest.raises(RuntimeError):
+        cache.acquire("key", fail)
+    assert "key" not in cache
+    assert cache.acquire("key", object).model is not None
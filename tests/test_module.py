@@ -0,0 +1,261 @@
+"""SeemoRe 网络结构测试 (随机初始化权重, 不需要下载模型)"""
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from seemore.cfgs import network_cfg
+from seemore.module import LayerNorm, SeemoRe, channel_shuffle, interpolate_region
+
+
+def build_model(model_name: str = "seemore_t_x2", seed: int = 0) -> SeemoRe:
+    """Build a randomly initialized model in eval mode"""
+    torch.manual_seed(seed)
+    return SeemoRe(**network_cfg(model_name)).eval()
+
+
+@torch.inference_mode()
+def test_batch_matches_single():
+    """批量推理的结果应与逐张推理一致"""
+    model = build_model()
+    torch.manual_seed(1)
+    x = torch.rand(4, 3, 32, 40)
+
+    batched = model(x)
+    single = torch.cat([model(x[i : i + 1]) for i in range(x.shape[0])])
+
+    assert batched.shape == (4, 3, 64, 80)
+    torch.testing.assert_close(batched, single, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("topk", [1, 2])
+@torch.inference_mode()
+def test_moe_layer_per_sample_routing(topk):
+    """MoELayer 应为每个样本单独选择专家"""
+    model = build_model()
+    moe_block = model.body[0].local_block.block
+    moe_layer = moe_block.moe_layer
+    moe_layer.num_expert = topk
+
+    torch.manual_seed(2)
+    inputs = torch.randn(6, moe_block.proj.in_channels, 8, 8)
+    k = torch.randn_like(inputs)
+
+    batched = moe_layer(inputs, k)
+    single = torch.cat(
+        [moe_layer(inputs[i : i + 1], k[i : i + 1]) for i in range(inputs.shape[0])]
+    )
+    torch.testing.assert_close(batched, single, rtol=1e-4, atol=1e-5)
+
+
+@torch.inference_mode()
+def test_stacked_experts_match_grouped():
+    """堆叠专家权重的推理路径应与逐专家推理一致"""
+    model = build_model()
+    torch.manual_seed(3)
+    x = torch.rand(3, 3, 24, 36)
+
+    expected = model(x)
+    model.stack_experts()
+    torch.testing.assert_close(model(x), expected, rtol=1e-4, atol=1e-5)
+
+
+def test_stacked_experts_traceable():
+    """堆叠专家后模型可被 trace, 且 trace 结果适用于其他输入"""
+    model = build_model().stack_experts()
+    torch.manual_seed(4)
+    x = torch.rand(2, 3, 32, 32)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, x)
+        other = torch.rand(2, 3, 32, 32)
+        torch.testing.assert_close(traced(other), model(other), rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("tile_size,batch_size", [(32, 1), (48, 3)])
+@torch.inference_mode()
+def test_tiled_forward_matches_forward(tile_size, batch_size):
+    """共享全图路由与校准的分块推理应与整图推理一致"""
+    model = build_model().stack_experts()
+    torch.manual_seed(5)
+    x = torch.rand(2, 3, 75, 90)
+    expected = model(x)
+
+    output = torch.zeros_like(expected)
+    for (y_start, y_end, x_start, x_end), tile in model.tiled_forward(
+        x, tile_size, batch_size
+    ):
+        output[:, :, y_start * 2 : y_end * 2, x_start * 2 : x_end * 2] = tile
+    torch.testing.assert_close(output, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_interpolate_region():
+    """插值区域应与整图 F.interpolate 的对应区域一致"""
+    torch.manual_seed(6)
+    x = torch.randn(2, 4, 5, 7)
+    expected = F.interpolate(x, size=(83, 117), mode="bilinear", align_corners=False)
+    region = interpolate_region(x, (83, 117), (10, 20, 40, 50))
+    torch.testing.assert_close(region, expected[:, :, 10:50, 20:70])
+
+
+@pytest.mark.parametrize("size", [(16, 16), (33, 47)])
+@torch.inference_mode()
+def test_prepare_bgr_uint8(size):
+    """折叠 BGR 与归一化后的模型应与原模型一致, 包括图像边缘"""
+    model = build_model("seemore_t_x3")
+    torch.manual_seed(7)
+    bgr = torch.randint(0, 256, (2, 3) + size).float()
+
+    expected = model(bgr.flip(1) / 255.0).flip(1) * 255.0
+    model.prepare_bgr_uint8()
+    torch.testing.assert_close(model(bgr), expected, rtol=1e-4, atol=1e-3)
+
+
+@pytest.mark.parametrize("size", [(1, 1), (1, 4), (2, 5), (6, 3)])
+@torch.inference_mode()
+def test_mean_folded_conv_border(size):
+    """折叠均值后的 conv_1 在边缘处应与原 conv_1 一致"""
+    model = build_model()
+    torch.manual_seed(8)
+    bgr = torch.randint(0, 256, (2, 3) + size).float()
+
+    conv_1 = model.conv_1
+    expected = conv_1((bgr.flip(1) / 255.0 - model.mean) * model.img_range)
+    model.prepare_bgr_uint8()
+    torch.testing.assert_close(model.conv_1(bgr), expected, rtol=1e-4, atol=1e-5)
+
+
+def test_mean_buffer():
+    """mean 是随模型移动的非持久 buffer, forward 不修改模型状态"""
+    model = build_model().double()
+    assert "mean" not in model.state_dict()
+    assert model.mean.dtype == torch.float64
+    mean = model.mean
+    model(torch.rand(1, 3, 16, 16, dtype=torch.float64))
+    assert model.mean is mean
+
+
+@torch.no_grad()
+def test_compile_matches_eager():
+    """torch.compile 编译后的模型应与 eager 模式一致"""
+    cfg = network_cfg("seemore_t_x2")
+    cfg["num_layers"] = 1
+    torch.manual_seed(9)
+    model = SeemoRe(**cfg).eval().stack_experts().prepare_bgr_uint8()
+    compiled = torch.compile(model, dynamic=False)
+    for size in [(32, 32), (48, 32)]:
+        x = torch.randint(0, 256, (2, 3) + size).float()
+        torch.testing.assert_close(compiled(x), model(x), rtol=1e-4, atol=1e-3)
+
+
+def randomize_norms(model: SeemoRe) -> SeemoRe:
+    """Random LayerNorm affines, the initial ones are the identity"""
+    torch.manual_seed(10)
+    with torch.no_grad():
+        for name, param in model.named_parameters():
+            if "norm" in name:
+                param.copy_(torch.randn_like(param) * 0.5 + (name.endswith("weight")))
+    return model
+
+
+@pytest.mark.parametrize("size", [(16, 16), (17, 33), (33, 47)])
+@torch.inference_mode()
+def test_prepare_for_inference(size):
+    """权重折叠后的模型应与原模型一致, 包括图像边缘"""
+    model = randomize_norms(build_model("seemore_t_x3")).stack_experts()
+    assert model.body[0].local_block.block.use_shuffle
+    torch.manual_seed(11)
+    x = torch.rand((2, 3) + size)
+
+    expected = model(x)
+    model.prepare_for_inference()
+    torch.testing.assert_close(model(x), expected, rtol=1e-4, atol=1e-5)
+
+    block = model.body[0].local_block.block
+    assert not block.use_shuffle
+    assert not model.body[0].global_block.norm_1.affine
+    # Idempotent
+    model.prepare_for_inference()
+    torch.testing.assert_close(model(x), expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("size", [(1, 4), (2, 2), (3, 7)])
+@torch.inference_mode()
+def test_fused_striped_conv_border(size):
+    """融合后的 3x3 条纹卷积在上下边缘处应与原卷积一致"""
+    model = build_model()
+    striped = model.body[0].local_block.block.conv_2[0]
+    torch.manual_seed(12)
+    for param in striped.parameters():
+        param.copy_(torch.randn_like(param))
+    x = torch.randn((2, striped.in_ch) + size)
+    torch.testing.assert_close(striped.fuse()(x), striped(x), rtol=1e-4, atol=1e-5)
+
+
+@torch.inference_mode()
+def test_prepare_for_inference_tiled():
+    """折叠后的分块推理应与折叠前的整图推理一致"""
+    model = randomize_norms(build_model()).stack_experts().prepare_bgr_uint8()
+    torch.manual_seed(13)
+    x = torch.randint(0, 256, (1, 3, 75, 90)).float()
+    expected = model(x)
+
+    model.prepare_for_inference()
+    output = torch.zeros_like(expected)
+    for (y_start, y_end, x_start, x_end), tile in model.tiled_forward(x, 32):
+        output[:, :, y_start * 2 : y_end * 2, x_start * 2 : x_end * 2] = tile
+    torch.testing.assert_close(output, expected, rtol=1e-4, atol=1e-3)
+
+
+@pytest.mark.parametrize("affine", [True, False])
+@pytest.mark.parametrize(
+    "memory_format", [torch.contiguous_format, torch.channels_last]
+)
+@torch.inference_mode()
+def test_layer_norm_channels_first(affine, memory_format):
+    """融合的 channels_first LayerNorm 应与逐步计算的均值方差一致"""
+    norm = LayerNorm(16, data_format="channels_first")
+    torch.manual_seed(14)
+    norm.weight.normal_()
+    norm.bias.normal_()
+    norm.affine = affine
+    x = torch.randn(2, 16, 7, 9).contiguous(memory_format=memory_format) * 3 + 1
+
+    u = x.mean(1, keepdim=True)
+    s = (x - u).pow(2).mean(1, keepdim=True)
+    expected = (x - u) / torch.sqrt(s + norm.eps)
+    if affine:
+        expected = norm.weight[:, None, None] * expected + norm.bias[:, None, None]
+    output = norm(x)
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+    # 输出保持输入的内存布局
+    assert output.is_contiguous(memory_format=memory_format)
+
+
+@pytest.mark.parametrize("prepared", [False, True])
+@torch.inference_mode()
+def test_channels_last(prepared):
+    """channels_last 模型与输入的结果应与 NCHW 一致, 输出保持 channels_last"""
+    model = build_model().stack_experts()
+    if prepared:
+        model.prepare_bgr_uint8().prepare_for_inference()
+    torch.manual_seed(15)
+    x = torch.rand(2, 3, 32, 40) * (255 if prepared else 1)
+    expected = model(x)
+    assert expected.is_contiguous()
+
+    model = model.to(memory_format=torch.channels_last)
+    output = model(x.contiguous(memory_format=torch.channels_last))
+    assert output.is_contiguous(memory_format=torch.channels_last)
+    torch.testing.assert_close(output, expected, rtol=1e-4, atol=1e-3)
+
+
+@pytest.mark.parametrize(
+    "memory_format", [torch.contiguous_format, torch.channels_last]
+)
+def test_channel_shuffle(memory_format):
+    """channel_shuffle 保持输入的内存布局"""
+    x = torch.randn(2, 8, 3, 5).contiguous(memory_format=memory_format)
+    shuffled = channel_shuffle(x, groups=2)
+    assert shuffled.is_contiguous(memory_format=memory_format)
+    expected = x.view(2, 2, 4, 3, 5).transpose(1, 2).reshape(2, 8, 3, 5)
+    torch.testing.assert_close(shuffled, expected, rtol=0, atol=0)
@@ -0,0 +1,96 @@
+"""测试 ONNX 导出与 ONNX Runtime 推理"""
+
+import os
+import subprocess
+import sys
+
+import cv2
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from seemore import OrtUpscaler, SeemoReUpscaler  # noqa: E402
+
+test_img_path = os.path.join(os.path.dirname(__file__), "bunny.jpeg")
+src_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "src")
+
+
+@pytest.fixture(scope="module")
+def onnx_path(tmp_path_factory):
+    from seemore.core import export_onnx
+
+    return export_onnx("seemore_t_x2", str(tmp_path_factory.mktemp("onnx") / "t.onnx"))
+
+
+@pytest.fixture(scope="module")
+def reference():
+    return SeemoReUpscaler("seemore_t_x2", device="cpu")
+
+
+@pytest.mark.parametrize("size", [(40, 60), (33, 47), (70, 90)])
+def test_ort_upscaler_matches_eager(onnx_path, reference, size):
+    """导出的 ONNX 模型支持任意尺寸, 结果与 eager 模型一致"""
+    img = cv2.imread(test_img_path)[: size[0], : size[1]]
+    upscaler = OrtUpscaler("seemore_t_x2", onnx_path=onnx_path)
+
+    result = upscaler(img)
+    assert result.shape == (size[0] * 2, size[1] * 2, 3)
+    assert np.abs(result.astype(int) - reference(img).astype(int)).max() <= 1
+
+
+def test_ort_upscaler_modes(onnx_path, reference):
+    """灰度, BGRA 与分块推理"""
+    img = cv2.imread(test_img_path)[:70, :90]
+    upscaler = OrtUpscaler("seemore_t_x2", onnx_path=onnx_path)
+
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    assert np.abs(upscaler(gray).astype(int) - reference(gray).astype(int)).max() <= 1
+
+    bgra = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+    assert upscaler(bgra).shape == (140, 180, 4)
+
+    tiled = upscaler(img, tile_size=32)
+    diff = np.abs(tiled.astype(int) - reference(img).astype(int))
+    assert diff.mean() < 0.01
+
+
+def test_ort_upscaler_without_torch(onnx_path):
+    """ONNX Runtime 推理不导入 torch"""
+    code = (
+        "import sys, numpy as np; "
+        "from seemore import OrtUpscaler; "
+        f"upscaler = OrtUpscaler('seemore_t_x2', onnx_path={onnx_path!r}); "
+        "assert upscaler(np.zeros((32, 48, 3), np.uint8)).shape == (64, 96, 3); "
+        "assert 'torch' not in sys.modules"
+    )
+    env = dict(os.environ, PYTHONPATH=src_dir)
+    subprocess.run([sys.executable, "-c", code], check=True, env=env)
+
+
+def test_onnxruntime_backend(onnx_path, reference, monkeypatch):
+    """SeemoReUpscaler 的 onnxruntime 后端"""
+    import seemore.core
+
+    monkeypatch.setattr(seemore.core, "onnx_artifact_path", lambda *args: onnx_path)
+    upscaler = SeemoReUpscaler(
+        "seemore_t_x2", device="cpu", backend="onnxruntime", cache=False
+    )
+    img = cv2.imread(test_img_path)[:70, :90]
+    expected = reference(img).astype(int)
+    assert np.abs(upscaler(img).astype(int) - expected).max() <= 1
+    # 自动选择 tile_pad 时使用 eager 模型计算梯度
+    tiled = upscaler(img, tile_size=32)
+    assert np.abs(tiled.astype(int) - expected).mean() < 0.01
+
+    from seemore.manager import model_nbytes
+
+    # 内存预算按 ONNX 文件大小计算
+    assert model_nbytes(upscaler.model) == os.path.getsize(onnx_path)
+
+    with pytest.raises(ValueError):
+        SeemoReUpscaler(
+            "seemore_t_x2", device="cpu", dtype=torch.float16, backend="onnxruntime"
+        )